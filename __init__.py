@@ -16,26 +16,22 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with opendrop_plugin.  If not, see <http://www.gnu.org/licenses/>.
 """
+import time
+_import_start_time = time.time()
+
 import os
 import math
 import re
+import threading
 from copy import deepcopy
-import warnings
-
-import tables
 from datetime import datetime
-from pygtkhelpers.ui.dialogs import info as info_dialog
-import yaml
-import gtk
+
 import gobject
-import numpy as np
 from path_helpers import path
 from flatland import Integer, Boolean, Float, Form, Enum, String
 from flatland.validation import ValueAtLeast, ValueAtMost, Validator
 import microdrop_utility as utility
-from microdrop_utility.gui import yesno, FormViewDialog
 from microdrop.logger import logger
-from microdrop.gui.protocol_grid_controller import ProtocolGridController
 from microdrop.plugin_helpers import (StepOptionsController, AppDataController,
                                       get_plugin_info)
 from microdrop.plugin_manager import (IPlugin, IWaveformGenerator, Plugin,
@@ -45,22 +41,41 @@ from microdrop.plugin_manager import (IPlugin, IWaveformGenerator, Plugin,
                                       get_service_instance_by_name)
 from microdrop.app_context import get_app
 from microdrop.dmf_device import DeviceScaleNotSet
-from serial_device import SerialDevice, get_serial_ports
 
 from opendrop_board import OpenDropBoard
-
-# Ignore natural name warnings from PyTables [1].
-#
-# [1]: https://www.mail-archive.com/pytables-users@lists.sourceforge.net/msg01130.html
-warnings.simplefilter('ignore', tables.NaturalNameWarning)
+from board_worker import BoardWorker
+from step_timer import StepTimer, monotonic
+from actuation_plan import ActuationPlan, validate_waveforms
+from channel_map import FIRST_PIN, N_PINS
+from channel_state import ChannelState
+from diagnostics import LatencyStats
+from actuation_log import ActuationLogWriter
+from board_group import BoardShard, Barrier, parse_board_map
+from connection_watchdog import ConnectionWatchdog
+from protocol_estimate import LatencyModel, estimate_protocol
 
 PluginGlobals.push_env('microdrop.managed')
 
+# time (in ms) over which bursts of step runs and protocol grid refreshes
+# are merged into a single update
+COALESCE_INTERVAL = 25
+
+
+_plugin_info = None
+
+
+def _get_plugin_info():
+    """Return the plugin info (read from disk the first time only)"""
+    global _plugin_info
+
+    if _plugin_info is None:
+        _plugin_info = get_plugin_info(path(__file__).parent)
+    return _plugin_info
+
 
 def max_voltage(element, state):
     """Verify that the voltage is below a set maximum"""
-    service = get_service_instance_by_name(
-        get_plugin_info(path(__file__).parent).plugin_name)
+    service = get_service_instance_by_name(_get_plugin_info().plugin_name)
 
     if service.control_board.connected() and \
         element.value > service.control_board.max_waveform_voltage:
@@ -73,8 +88,7 @@ def max_voltage(element, state):
 
 def check_frequency(element, state):
     """Verify that the frequency is within the valid range"""
-    service = get_service_instance_by_name(
-        get_plugin_info(path(__file__).parent).plugin_name)
+    service = get_service_instance_by_name(_get_plugin_info().plugin_name)
 
     if service.control_board.connected() and \
         (element.value < service.control_board.min_waveform_frequency or \
@@ -88,6 +102,29 @@ def check_frequency(element, state):
         return True
 
 
+def _app_fields(serial_ports):
+    """Return the app options form for the specified serial ports"""
+    if len(serial_ports):
+        default_port = serial_ports[0]
+    else:
+        default_port = None
+
+    return Form.of(
+        Enum.named('serial_port').using(default=default_port,
+                                        optional=True).valued(*serial_ports),
+        Integer.named('baud_rate')
+        .using(default=115200, optional=True, validators=[ValueAtLeast(minimum=0),
+                                                     ],),
+        Float.named('multiplex_refresh_rate')
+        .using(default=25, optional=True,
+               validators=[ValueAtLeast(minimum=1), ]),
+        Boolean.named('actuation_trace').using(default=False, optional=True),
+        # channel ranges driven by each board, e.g. "0-67:COM3, 68-135:COM4"
+        # (empty for a single board on `serial_port`)
+        String.named('board_map').using(default='', optional=True),
+    )
+
+
 class OpenDropPlugin(Plugin, StepOptionsController, AppDataController):
     """
     This class is automatically registered with the PluginManager.
@@ -95,19 +132,9 @@ class OpenDropPlugin(Plugin, StepOptionsController, AppDataController):
     implements(IPlugin)
     implements(IWaveformGenerator)
 
-    serial_ports_ = [port for port in get_serial_ports()]
-    if len(serial_ports_):
-        default_port_ = serial_ports_[0]
-    else:
-        default_port_ = None
-
-    AppFields = Form.of(
-        Enum.named('serial_port').using(default=default_port_,
-                                        optional=True).valued(*serial_ports_),
-        Integer.named('baud_rate')
-        .using(default=115200, optional=True, validators=[ValueAtLeast(minimum=0),
-                                                     ],),
-    )
+    # serial ports are enumerated on demand (see refresh_serial_ports())
+    serial_ports_ = []
+    AppFields = _app_fields(serial_ports_)
 
     StepFields = Form.of(
         Integer.named('duration').using(default=100, optional=True,
@@ -121,37 +148,150 @@ class OpenDropPlugin(Plugin, StepOptionsController, AppDataController):
                                                    check_frequency]),
     )
 
-    version = get_plugin_info(path(__file__).parent).version
+    version = _get_plugin_info().version
+
+    @classmethod
+    def refresh_serial_ports(cls):
+        '''
+        Enumerate the available serial ports and update the choices of the
+        `serial_port` app option.
+        '''
+        from serial_device import get_serial_ports
+
+        serial_ports = [port for port in get_serial_ports()]
+        if serial_ports != cls.serial_ports_:
+            cls.serial_ports_ = serial_ports
+            cls.AppFields = _app_fields(serial_ports)
+        return serial_ports
 
     def __init__(self):
+        start_time = time.time()
         self.control_board = OpenDropBoard()
-        self.name = get_plugin_info(path(__file__).parent).plugin_name
+        # all serial communication with the board goes through this thread
+        gobject.threads_init()
+        self.board_worker = BoardWorker(self.control_board,
+                                        dispatch=gobject.idle_add)
+        self.board_worker.start()
+        # boards driving the device's channels (control_board is always the
+        # first); see _update_shards()
+        self.shards = [BoardShard(0, self.control_board.number_of_channels(),
+                                  self.control_board, self.board_worker)]
+        self._board_map = ''
+        # pings the boards and reconnects them if the link drops
+        self.watchdog = ConnectionWatchdog(
+            lambda: [(shard.board, shard.worker) for shard in self.shards],
+            dispatch=gobject.idle_add,
+            on_restored=self._on_connection_restored)
+        self.watchdog.start()
+        self.name = _get_plugin_info().plugin_name
         self.connection_status = "Not connected"
         self.current_frequency = None
+        self.current_voltage = None
         self.timeout_id = None
+        self.duty_cycle = None
+        # incremented on each step so that completion callbacks for stale
+        # steps can be ignored
+        self._step_id = 0
+        self.step_timer = StepTimer()
+        # time from on_step_run until the board has applied the step's state
+        self.actuation_stats = LatencyStats()
+        self.actuation_plan = None
+        # protocol steps that the actuation plan was compiled from
+        self._plan_steps = []
+        # HDF5 log of the applied steps (one per experiment)
+        self.actuation_log = None
+        # timeout ids of the coalesced updates waiting to run, and the number
+        # of requests merged into them (see _coalesce())
+        self._pending_updates = {}
+        self.coalesced_updates = {}
+        # True while the boards are being flashed (see on_flash_firmware())
+        self._flashing = False
+        # True once the actuation traces have been dumped for the current
+        # failure (reset when the connection is restored)
+        self._traces_dumped = False
+        # time from the start of the module import until the plugin is ready
+        self.startup_time = time.time() - _import_start_time
+        logger.info('[OpenDropPlugin] started in %.3f s (__init__: %.3f s)' %
+                    (self.startup_time, time.time() - start_time))
 
     def on_plugin_enable(self):
+        self.refresh_serial_ports()
         super(OpenDropPlugin, self).on_plugin_enable()
+        self._enable_actuation_trace(self.get_app_values()
+                                     .get('actuation_trace'))
         self.check_device_name_and_version()
         if get_app().protocol:
             self.on_step_run()
-            self._update_protocol_grid()
+            self._coalesce('protocol_grid', self._update_protocol_grid)
 
     def on_plugin_disable(self):
         if get_app().protocol:
             self.on_step_run()
-            self._update_protocol_grid()
+            self._coalesce('protocol_grid', self._update_protocol_grid)
 
     def on_protocol_swapped(self, old_protocol, protocol):
-        self._update_protocol_grid()
+        self.actuation_plan = None
+        self.validate_protocol()
+        self._coalesce('protocol_grid', self._update_protocol_grid)
+
+    def validate_protocol(self):
+        '''
+        Check the waveform of every step of the protocol against the limits
+        of the control board (in a single pass) and log any problems.
+
+        Returns:
+            list of (step_number, message) tuples
+        '''
+        app = get_app()
+        board = self.control_board
+        if app.protocol is None or not board.connected():
+            return []
+        options = [self.get_step_options(i)
+                   for i in range(len(app.protocol.steps))]
+        errors = validate_waveforms([o['voltage'] for o in options],
+                                    [o['frequency'] for o in options],
+                                    board.max_waveform_voltage,
+                                    board.min_waveform_frequency,
+                                    board.max_waveform_frequency)
+        for step_number, error in errors:
+            logger.warning("Warning: step %d: %s" % (step_number + 1, error))
+        return errors
         
     def _update_protocol_grid(self):
+        # loads gtk, so only import it once the grid needs refreshing
+        from microdrop.gui.protocol_grid_controller import \
+            ProtocolGridController
+
         app = get_app()
         app_values = self.get_app_values()
         pgc = get_service_instance(ProtocolGridController, env='microdrop')
         if pgc.enabled_fields:
             pgc.update_grid()
 
+    def _coalesce(self, name, function):
+        '''
+        Call `function` from the main loop after COALESCE_INTERVAL ms. Any
+        other request with the same name made in the meantime is merged into
+        this call (and counted in `coalesced_updates`).
+        '''
+        if name in self._pending_updates:
+            self.coalesced_updates[name] = (self.coalesced_updates
+                                            .get(name, 0) + 1)
+            return
+
+        def _run():
+            del self._pending_updates[name]
+            function()
+            return False  # only run once
+
+        self._pending_updates[name] = gobject.timeout_add(COALESCE_INTERVAL,
+                                                          _run)
+
+    def _cancel_pending_update(self, name):
+        timeout_id = self._pending_updates.pop(name, None)
+        if timeout_id is not None:
+            gobject.source_remove(timeout_id)
+
     def on_app_options_changed(self, plugin_name):
         app = get_app()
         if plugin_name == self.name:
@@ -165,20 +305,21 @@ class OpenDropPlugin(Plugin, StepOptionsController, AppDataController):
                         reconnect = True
                     if k == 'serial_port' and self.control_board.port != v:
                         reconnect = True
+                    if k == 'board_map' and (v or '') != self._board_map:
+                        reconnect = True
 
             if reconnect:
                 self.connect()
-                
-            self._update_protocol_grid()
+
+            self._enable_actuation_trace(app_values.get('actuation_trace'))
+            self._coalesce('protocol_grid', self._update_protocol_grid)
         elif plugin_name == app.name:
             # Turn off all electrodes if we're not in realtime mode and not
             # running a protocol.
-            if (self.control_board.connected() and not app.realtime_mode and
+            if (self.boards_connected() and not app.realtime_mode and
                 not app.running):
                 logger.info('Turning off all electrodes.')
-                self.control_board.set_state_of_all_channels(
-                    np.zeros(self.control_board.number_of_channels())
-                )
+                self._clear_all_boards()
 
     def connect(self):
         '''
@@ -187,25 +328,109 @@ class OpenDropPlugin(Plugin, StepOptionsController, AppDataController):
 
         If unsuccessful, try to connect to the control board on any available
         serial port, one-by-one.
+
+        If the `board_map` app option assigns channel ranges to several
+        boards, connect to all of them (concurrently) instead.
         '''
+        # connecting can take longer than the watchdog's stall timeout
+        self.watchdog.pause()
+        try:
+            self._connect()
+        finally:
+            self.watchdog.resume()
+
+    def _connect(self):
+        # the waveform must be resent after (re)connecting
         self.current_frequency = None
-        if len(OpenDropPlugin.serial_ports_):
-            app_values = self.get_app_values()
-            # try to connect to the last successful port
+        self.current_voltage = None
+        # the board limits used to validate the plan may have changed
+        self.actuation_plan = None
+        app_values = self.get_app_values()
+        self._update_shards(app_values.get('board_map'))
+        if len(self.shards) > 1:
+            self._connect_shards(app_values['baud_rate'])
+        elif len(self.refresh_serial_ports()):
+            # try to connect to the port of a single-entry board map, or to
+            # the last successful port
+            serial_port = self.shards[0].port or app_values['serial_port']
             try:
-                self.control_board.connect(str(app_values['serial_port']),
-                    app_values['baud_rate'])
+                self.board_worker.call('connect', str(serial_port),
+                                       app_values['baud_rate'])
             except RuntimeError, why:
                 logger.warning('Could not connect to control board on port %s.'
                                ' Checking other ports... [%s]' %
-                               (app_values['serial_port'], why))
+                               (serial_port, why))
                 
-                self.control_board.connect(baud_rate=app_values['baud_rate'])
+                self.board_worker.call('connect', None,
+                                       app_values['baud_rate'])
             app_values['serial_port'] = self.control_board.port
             self.set_app_values(app_values)
         else:
             raise Exception("No serial ports available.")
 
+    def _update_shards(self, board_map):
+        '''
+        Create a board and worker for each entry of the board map (the first
+        entry is driven by control_board). If the map is empty, control_board
+        drives every channel.
+        '''
+        board_map = board_map or ''
+        if board_map == self._board_map:
+            return
+        entries = parse_board_map(board_map)
+        if not entries:
+            entries = [(0, self.control_board.number_of_channels(), None)]
+        for shard in self.shards[1:]:
+            shard.worker.call('disconnect')
+            shard.worker.stop()
+        first_channel, n_channels, port = entries[0]
+        self.shards = [BoardShard(first_channel, n_channels,
+                                  self.control_board, self.board_worker,
+                                  port)]
+        for first_channel, n_channels, port in entries[1:]:
+            board = OpenDropBoard()
+            board.trace.enabled = self.control_board.trace.enabled
+            worker = BoardWorker(board, dispatch=gobject.idle_add)
+            worker.start()
+            self.shards.append(BoardShard(first_channel, n_channels, board,
+                                          worker, port))
+        self._board_map = board_map
+        self.actuation_plan = None
+        logger.info('[OpenDropPlugin] driving %d channels with %d boards: %s'
+                    % (self.number_of_channels(), len(self.shards),
+                       self.shards))
+        if (self.actuation_log is not None and
+            self.actuation_log.n_channels != self.number_of_channels()):
+            # the records of the open log are too narrow (or too wide) for
+            # the new channel count
+            self._open_actuation_log(self.actuation_log.path.parent)
+
+    def _connect_shards(self, baud_rate):
+        '''
+        Connect every board of the board map concurrently.
+        '''
+        results = [shard.worker.submit('connect', shard.port, baud_rate)
+                   for shard in self.shards]
+        for shard, result in zip(self.shards, results):
+            result.wait()
+            if result.error is not None:
+                raise RuntimeError('Could not connect to the board on port '
+                                   '%s: %s' % (shard.port, result.error))
+
+    def boards_connected(self):
+        return all(shard.board.connected() for shard in self.shards)
+
+    def number_of_channels(self):
+        '''
+        Return the number of channels driven by all boards.
+        '''
+        return max(shard.first_channel + shard.n_channels
+                   for shard in self.shards)
+
+    def _clear_all_boards(self):
+        for shard in self.shards:
+            shard.worker.set_state([ChannelState()])
+
     def check_device_name_and_version(self):
         '''
         Check to see if:
@@ -217,33 +442,52 @@ class OpenDropPlugin(Plugin, StepOptionsController, AppDataController):
         dialog offering to flash the device with the firmware version that
         matches the host driver API version.
         '''
+        if self._flashing:
+            return
         try:
             self.connect()
-            name = self.control_board.name()
-            if name != "open_drop":
+            properties = self.board_worker.call('properties')
+            if properties['name'] != "open_drop":
                 raise Exception("Device is not an OpenDrop")
 
             host_software_version = self.control_board.host_software_version()
-            remote_software_version = self.control_board.software_version()
+            remote_software_version = properties['software_version']
 
             # Reflash the firmware if it is not the right version.
             if host_software_version != remote_software_version:
+                import gtk
+                from microdrop_utility.gui import yesno
+
                 response = yesno("The control board firmware version (%s) "
                                  "does not match the driver version (%s). "
                                  "Update firmware?" % (remote_software_version,
                                                        host_software_version))
                 if response == gtk.RESPONSE_YES:
+                    # flashing runs in the background, and the status is
+                    # refreshed once it is done (see
+                    # _callback_firmware_flashed())
                     self.on_flash_firmware()
+                    return
         except Exception, why:
             logger.warning("%s" % why)
 
         self.update_connection_status()
 
     def on_flash_firmware(self, widget=None, data=None):
-        app = get_app()
+        '''
+        Flash every board that is not already running the firmware matching
+        the host driver. When called from the menu (i.e., with a widget),
+        every board is flashed, even if it already runs that firmware.
+
+        Boards are flashed concurrently by their BoardWorkers, so the GUI
+        stays responsive; progress is shown in the connection status.
+        '''
+        if self._flashing:
+            logger.warning('[OpenDropPlugin] firmware is already being '
+                           'flashed.')
+            return
         try:
-            connected = self.control_board.connected()
-            if not connected:
+            if not self.control_board.connected():
                 self.connect()
             '''
             response = yesno("Save current control board configuration before "
@@ -254,28 +498,109 @@ class OpenDropPlugin(Plugin, StepOptionsController, AppDataController):
             hardware_version = utility.Version.fromstring(
                 self.control_board.hardware_version()
             )
-            if connected:
-                self.control_board.disconnect()
-            self.control_board.flash_firmware(hardware_version)
-            app.main_window_controller.info("Firmware updated successfully.",
-                                            "Firmware update")
         except Exception, why:
             logger.error("Problem flashing firmware. ""%s" % why)
+            return
+
+        # an explicit request from the user (e.g., to recover a board whose
+        # firmware is corrupted) always flashes
+        force = widget is not None
+        # the boards are expected to go away while they are being flashed
+        self.watchdog.pause()
+        self._flashing = True
+        flashed = []
+
+        def on_flashed(value, error):
+            if value:
+                flashed.append(value)
+            return barrier(value, error)
+
+        barrier = Barrier(len(self.shards),
+                          lambda value, error:
+                          self._callback_firmware_flashed(len(flashed),
+                                                          error))
+        for shard in self.shards:
+            progress = (lambda message, fraction, port=shard.port:
+                        gobject.idle_add(self._on_flash_progress, port,
+                                         message, fraction))
+            shard.worker.submit('flash_firmware', hardware_version, force,
+                                progress, callback=on_flashed)
+
+    def _on_flash_progress(self, port, message, fraction):
+        logger.info('[OpenDropPlugin] %s: %s' % (port or 'board', message))
+        self.connection_status = ('Flashing firmware (%s): %s (%d%%)' %
+                                  (port or 'board', message, 100 * fraction))
+        get_app().main_window_controller.label_control_board_status\
+            .set_text(self.connection_status)
+        return False  # only run once when called from gobject.idle_add
+
+    def _callback_firmware_flashed(self, n_flashed, error):
+        '''
+        Called once every board has been flashed (or skipped).
+        '''
+        self._flashing = False
+        self.watchdog.resume()
+        app = get_app()
+        if error is not None:
+            logger.error("Problem flashing firmware. ""%s" % error)
+            self.update_connection_status()
+            return False
+        if n_flashed:
+            app.main_window_controller.info("Firmware updated successfully "
+                                            "(%d of %d boards flashed)." %
+                                            (n_flashed, len(self.shards)),
+                                            "Firmware update")
+        else:
+            logger.info('[OpenDropPlugin] firmware is already up to date.')
         self.check_device_name_and_version()
+        return False
+
+    def _on_connection_restored(self, board, outage):
+        '''
+        Called (from the main loop) once the watchdog has reconnected a board
+        and re-applied its channel state.
+        '''
+        logger.warning('[OpenDropPlugin] connection to %s restored after '
+                       '%.1f s' % (outage.port, outage.duration))
+        self._traces_dumped = False
+        if (self.current_voltage is not None and
+            self.current_frequency is not None):
+            self.apply_waveform(self.current_voltage, self.current_frequency,
+                                force=True)
+        self.update_connection_status()
+        return False  # only run once when called from gobject.idle_add
 
     def update_connection_status(self):
+        if self._flashing:
+            # board commands would wait for the flash to finish; the status
+            # shows its progress instead
+            return
         self.connection_status = "Not connected"
         app = get_app()
         connected = self.control_board.connected()
         if connected:
-            name = self.control_board.name()
+            properties = self.board_worker.call('properties')
+            name = properties['name']
             version = self.control_board.hardware_version()
-            firmware = self.control_board.software_version()
-            n_channels = self.control_board.number_of_channels()
+            firmware = properties['software_version']
+            n_channels = self.number_of_channels()
             serial_number = self.control_board.serial_number
             self.connection_status = ('%s v%s (Firmware: %s, S/N %03d)\n'
             '%d channels' % (name, version, firmware, serial_number,
                              n_channels))
+            if len(self.shards) > 1:
+                self.connection_status += (' on %d boards (%d connected)' %
+                                           (len(self.shards),
+                                            sum(shard.board.connected()
+                                                for shard in self.shards)))
+            step_actuation = (self.actuation_stats.summary()
+                              .get('step_actuation'))
+            if step_actuation:
+                self.connection_status += ('\nStep actuation: p50 %.1f ms, '
+                                           'p95 %.1f ms (%d steps)' %
+                                           (step_actuation['p50'],
+                                            step_actuation['p95'],
+                                            step_actuation['count']))
 
         app.main_window_controller.label_control_board_status\
            .set_text(self.connection_status)
@@ -288,46 +613,262 @@ class OpenDropPlugin(Plugin, StepOptionsController, AppDataController):
         signal once they have completed the step. The protocol controller
         will wait until all plugins have completed the current step before
         proceeding.
+
+        Channel states are applied asynchronously by the board worker. While
+        a protocol is running, each step ends at a deadline measured from the
+        start of the run (see StepTimer), so the time taken to apply a state
+        is subtracted from the step duration instead of accumulating.
+
+        Outside of a protocol run (e.g., while editing a step in realtime
+        mode), bursts of step runs within COALESCE_INTERVAL are merged into
+        a single actuation of the latest state.
         """
         logger.debug('[OpenDropPlugin] on_step_run()')
         self._kill_running_step()
+        self._step_id += 1
+        if get_app().running:
+            self._cancel_pending_update('step_run')
+            self._run_step()
+        else:
+            self._coalesce('step_run', self._run_step)
+
+    def _run_step(self):
+        '''
+        Apply the waveform and channel states of the current step.
+        '''
+        step_start = monotonic()
         app = get_app()
-        options = self.get_step_options()
-        dmf_options = app.dmf_device_controller.get_step_options()
-        logger.debug('[OpenDropPlugin] options=%s dmf_options=%s' %
-                     (options, dmf_options))
+        if app.protocol is None:
+            return
+        step_number = app.protocol.current_step_number
+        step = self._get_step_plan(step_number)
+        logger.debug('[OpenDropPlugin] step #%d: duration=%s voltage=%s '
+                     'frequency=%s', step_number, step.duration,
+                     step.voltage, step.frequency)
         app_values = self.get_app_values()
+        if app.running:
+            self.step_timer.start_step(step_number, step.duration)
 
-        if (self.control_board.connected() and (app.realtime_mode or
-                                                app.running)):
+        if (self.boards_connected() and (app.realtime_mode or
+                                         app.running)):
+            self.apply_waveform(step.voltage, step.frequency)
 
-            state = dmf_options.state_of_channels
-            max_channels = self.control_board.number_of_channels()
-            if len(state) > max_channels:
-                state = state[0:max_channels]
-            elif len(state) < max_channels:
-                state = np.concatenate([state, np.zeros(max_channels -
-                                                        len(state), int)])
-                assert(len(state) == max_channels)
+            self.duty_cycle = step.duty_cycle
+            refresh_rate = app_values['multiplex_refresh_rate']
+            n_frames = max(len(frames) for frames in step.shard_frames)
+            if n_frames > 1:
+                logger.info('[OpenDropPlugin] multiplexing %d frames at %.1f '
+                            'Hz (duty cycle=%.0f%%)' %
+                            (n_frames, refresh_rate, 100.0 / n_frames))
+            step_id = self._step_id
+            # the step is complete once every board has applied its state
+            barrier = Barrier(len(self.shards),
+                              lambda value, error:
+                              self._callback_state_applied(
+                                  step_id, error, step_start, step_number,
+                                  step))
+            for shard, frames, pin_levels in zip(self.shards,
+                                                 step.shard_frames,
+                                                 step.shard_pin_levels):
+                shard.worker.set_state(
+                    frames, refresh_rate, callback=barrier,
+                    step_number=step_number if app.running else None,
+                    pin_levels=pin_levels)
+        else:
+            self._callback_state_applied(self._step_id)
 
-            emit_signal("set_frequency",
-                        options['frequency'],
-                        interface=IWaveformGenerator)
-            emit_signal("set_voltage", options['voltage'],
-                        interface=IWaveformGenerator)
+    def _new_actuation_plan(self):
+        '''
+        Return an empty actuation plan, validated against the limits of the
+        control board if it is connected.
+        '''
+        board = self.control_board
+        shards = [(shard.first_channel, shard.n_channels)
+                  for shard in self.shards]
+        if board.connected():
+            return ActuationPlan(self.number_of_channels(),
+                                 board.max_waveform_voltage,
+                                 board.min_waveform_frequency,
+                                 board.max_waveform_frequency, shards)
+        return ActuationPlan(self.number_of_channels(), shards=shards)
+
+    def _get_step_inputs(self, step_number):
+        '''
+        Return the (options, state_of_channels) tuple for the specified step.
+        '''
+        dmf_options = (get_app().dmf_device_controller
+                       .get_step_options(step_number))
+        return (self.get_step_options(step_number),
+                dmf_options.state_of_channels)
 
-            self.control_board.set_state_of_all_channels(state)
+    def _compile_protocol(self):
+        '''
+        Compile the protocol into an actuation plan. If a plan already exists,
+        only recompile the steps that have been invalidated or have moved.
+        '''
+        steps = get_app().protocol.steps
+        if self.actuation_plan is None or len(self.actuation_plan) != len(steps):
+            self.actuation_plan = self._new_actuation_plan()
+            self.actuation_plan.compile([self._get_step_inputs(i)
+                                         for i in range(len(steps))])
+        else:
+            for i, step in enumerate(steps):
+                if (self.actuation_plan.get(i) is None or
+                    self._plan_steps[i] is not step):
+                    self.actuation_plan.update_step(i,
+                                                    *self._get_step_inputs(i))
+        self._plan_steps = list(steps)
 
-        # if a protocol is running, wait for the specified minimum duration
-        if app.running:
+    def _get_step_plan(self, step_number):
+        '''
+        Return the StepPlan for the specified step, using the precompiled
+        actuation plan while a protocol is running.
+        '''
+        app = get_app()
+        plan = self.actuation_plan
+        if (app.running and plan is not None and
+            len(plan) == len(app.protocol.steps) and
+            self._plan_steps[step_number] is app.protocol.steps[step_number]):
+            return (plan.get(step_number) or
+                    plan.update_step(step_number,
+                                     *self._get_step_inputs(step_number)))
+        return self._new_actuation_plan().compile_step(
+            *self._get_step_inputs(step_number))
+
+    def _callback_state_applied(self, step_id, error=None, step_start=None,
+                                step_number=None, step=None):
+        if step_start is not None and error is None:
+            latency = monotonic() - step_start
+            self.actuation_stats.record('step_actuation', latency)
+            if self.actuation_log is not None and step is not None:
+                # a logging problem must never keep the step from completing
+                try:
+                    self.actuation_log.append(step_number, step.state,
+                                              step.voltage, step.frequency,
+                                              latency)
+                except Exception, why:
+                    logger.warning('[OpenDropPlugin] could not log step %d: '
+                                   '%s' % (step_number, why))
+        if error is not None:
+            # don't wait for the next ping to find out whether the link is down
+            self.watchdog.check_now()
+        if (error is not None and self.control_board.trace.enabled and
+            not self._traces_dumped):
+            # only the first failed step of an outage is worth a dump
+            self._traces_dumped = True
+            self._dump_actuation_traces()
+        if step_id != self._step_id:
+            # a newer step has started since this state was requested
+            return False
+
+        # if a protocol is running, wait until the step's deadline
+        if get_app().running:
+            self.step_timer.state_applied()
+            remaining = self.step_timer.remaining()
             logger.debug('[OpenDropPlugin] on_step_run: '
-                         'timeout_add(%d, _callback_step_completed)' %
-                         options['duration'])
+                         'timeout_add(%d, _callback_step_completed)',
+                         remaining)
             self.timeout_id = gobject.timeout_add(
-                options['duration'], self._callback_step_completed)
-            return
+                remaining, self._callback_step_completed)
         else:
             self.step_complete()
+        return False  # only run once when called from gobject.idle_add
+
+    def get_actuation_metrics(self):
+        '''
+        Return performance metrics for the actuation path (combined over
+        every board of the board map).
+
+        Returns:
+            dictionary with the following keys:
+                latency : dictionary mapping each call type (proxy RPCs,
+                    `connect`, `flash_firmware` and `step_actuation`, the
+                    time from on_step_run until the board has applied the
+                    step's state) to its count and mean, p50, p95 and p99
+                    latency in ms
+                bytes_written, bytes_read : bytes transferred over the
+                    serial ports
+                superseded_states : number of channel states dropped because
+                    a newer state arrived before they were applied
+                coalesced_updates : dictionary mapping each kind of update
+                    (`step_run` and `protocol_grid`) to the number of
+                    requests merged into an earlier one
+                outages : number of connection outages recovered by the
+                    watchdog and their total and maximum duration (in
+                    seconds)
+        '''
+        boards = [shard.board for shard in self.shards]
+        latency = LatencyStats.combine([board.rpc_stats
+                                        for board in boards]).summary()
+        latency.update(self.actuation_stats.summary())
+        return {'latency': latency,
+                'bytes_written': sum(board.bytes_written for board in boards),
+                'bytes_read': sum(board.bytes_read for board in boards),
+                'superseded_states': sum(shard.worker.superseded_count
+                                         for shard in self.shards),
+                'coalesced_updates': dict(self.coalesced_updates),
+                'outages': self.watchdog.outage_summary()}
+
+    def _enable_actuation_trace(self, enabled):
+        for shard in self.shards:
+            shard.board.trace.enabled = bool(enabled)
+
+    def dump_actuation_trace(self, output=None, board_index=0):
+        '''
+        Write the actuation trace (see the actuation_trace app option) of a
+        board as CSV.
+
+        Parameters:
+            output : path or file-like object (defaults to
+                `opendrop_trace-<timestamp>.csv` in the experiment log
+                directory, or `opendrop_trace-<timestamp>-board<index>.csv`
+                for the other boards of the board map)
+            board_index : index of the board in the board map
+
+        Returns:
+            path or file-like object written to
+        '''
+        if output is None:
+            output = self._trace_path(board_index)
+        n_records = self.shards[board_index].board.trace.dump(
+            output, range(FIRST_PIN, FIRST_PIN + N_PINS))
+        logger.info('[OpenDropPlugin] wrote %d actuation trace records to %s'
+                    % (n_records, output))
+        return output
+
+    def _trace_path(self, board_index=0):
+        '''
+        Return a new path for the actuation trace of a board (see
+        dump_actuation_trace()).
+        '''
+        suffix = '-board%d' % board_index if board_index else ''
+        # include microseconds so that dumps made within the same second
+        # don't overwrite each other
+        return (path(get_app().experiment_log.get_log_path())
+                .joinpath('opendrop_trace-%s%s.csv' %
+                          (datetime.now().strftime('%Y%m%d-%H%M%S-%f'),
+                           suffix)))
+
+    def _dump_actuation_traces(self):
+        '''
+        Dump the actuation trace of every board from a background thread
+        (writing the traces can take a while and must not block the main
+        loop).
+        '''
+        outputs = [(self._trace_path(board_index), board_index)
+                   for board_index in range(len(self.shards))]
+
+        def _dump():
+            for output, board_index in outputs:
+                try:
+                    self.dump_actuation_trace(output, board_index)
+                except Exception, why:
+                    logger.warning('Could not write the actuation trace: %s'
+                                   % why)
+
+        thread = threading.Thread(target=_dump, name='OpenDropTraceDump')
+        thread.daemon = True
+        thread.start()
 
     def step_complete(self, return_value=None):
         app = get_app()
@@ -354,12 +895,44 @@ class OpenDropPlugin(Plugin, StepOptionsController, AppDataController):
         Handler called when a protocol starts running.
         """
         app = get_app()
-        if not self.control_board.connected():
+        self.step_timer.reset()
+        if not self.boards_connected():
             logger.warning("Warning: no control board connected.")
-        elif (self.control_board.number_of_channels() <=
-              app.dmf_device.max_channel()):
+        elif self.number_of_channels() <= app.dmf_device.max_channel():
             logger.warning("Warning: currently connected board does not have "
                            "enough channels for this protocol.")
+        self._compile_protocol()
+        for step_number, error in self.actuation_plan.errors():
+            logger.warning("Warning: step %d: %s" % (step_number + 1, error))
+        if self.boards_connected():
+            # the protocol has just been compiled
+            estimate = self.estimate_protocol_duration(recompile=False)
+            logger.info('[OpenDropPlugin] predicted run time: %.1f s (sum of '
+                        'step durations: %.1f s)' % (estimate.predicted_time,
+                                                     estimate.planned_time))
+            for step_number, warning in estimate.warnings():
+                logger.warning("Warning: step %d: %s" % (step_number + 1,
+                                                         warning))
+
+    def estimate_protocol_duration(self, recompile=True):
+        '''
+        Predict how long the protocol will take on the connected boards, from
+        the pin changes of each step and the latencies recently measured by
+        each board (see protocol_estimate.py).
+
+        Parameters:
+            recompile : if False, use the current actuation plan without
+                bringing it up to date with the protocol first
+
+        Returns:
+            ProtocolEstimate
+        '''
+        if recompile or self.actuation_plan is None:
+            self._compile_protocol()
+        models = [LatencyModel.fit(shard.board) for shard in self.shards]
+        return estimate_protocol(self.actuation_plan, models,
+                                 self.get_app_values()
+                                 ['multiplex_refresh_rate'])
 
     def on_protocol_pause(self):
         """
@@ -367,11 +940,16 @@ class OpenDropPlugin(Plugin, StepOptionsController, AppDataController):
         """
         app = get_app()
         self._kill_running_step()
-        if self.control_board.connected() and not app.realtime_mode:
+        if self.step_timer.records:
+            logger.info('[OpenDropPlugin] protocol paused after %d steps '
+                        '(drift=%.3f s)' % (len(self.step_timer.records),
+                                            self.step_timer.drift()))
+        self.step_timer.reset()
+        self.update_connection_status()
+        if self.boards_connected() and not app.realtime_mode:
             # Turn off all electrodes
             logger.debug('Turning off all electrodes.')
-            self.control_board.set_state_of_all_channels(
-                np.zeros(self.control_board.number_of_channels()))
+            self._clear_all_boards()
 
     def on_experiment_log_selection_changed(self, data):
         """
@@ -382,6 +960,24 @@ class OpenDropPlugin(Plugin, StepOptionsController, AppDataController):
         """
         pass
 
+    def apply_waveform(self, voltage, frequency, force=False):
+        '''
+        Emit the set_frequency and set_voltage signals to the waveform
+        generators, skipping any value that matches the waveform currently
+        applied.
+
+        Parameters:
+            voltage : RMS voltage
+            frequency : frequency in Hz
+            force : if True, emit both signals even if the values have not
+                changed (e.g., to recover after a reconnect)
+        '''
+        if force or frequency != self.current_frequency:
+            emit_signal("set_frequency", frequency,
+                        interface=IWaveformGenerator)
+        if force or voltage != self.current_voltage:
+            emit_signal("set_voltage", voltage, interface=IWaveformGenerator)
+
     def set_voltage(self, voltage):
         """
         Set the waveform voltage.
@@ -390,7 +986,8 @@ class OpenDropPlugin(Plugin, StepOptionsController, AppDataController):
             voltage : RMS voltage
         """
         logger.info("[OpenDropPlugin].set_voltage(%.1f)" % voltage)
-        self.control_board.set_waveform_voltage(voltage)
+        self.board_worker.submit('set_waveform_voltage', voltage)
+        self.current_voltage = voltage
 
     def set_frequency(self, frequency):
         """
@@ -400,15 +997,17 @@ class OpenDropPlugin(Plugin, StepOptionsController, AppDataController):
             frequency : frequency in Hz
         """
         logger.info("[OpenDropPlugin].set_frequency(%.1f)" % frequency)
-        self.control_board.set_waveform_frequency(frequency)
+        self.board_worker.submit('set_waveform_frequency', frequency)
         self.current_frequency = frequency
 
     def on_step_options_changed(self, plugin, step_number):
         logger.debug('[OpenDropPlugin] on_step_options_changed(): %s '
                      'step #%d' % (plugin, step_number))
         app = get_app()
-        app_values = self.get_app_values()
-        options = self.get_step_options(step_number)
+        if (self.actuation_plan is not None and
+            (plugin == 'microdrop.gui.dmf_device_controller' or
+             plugin == self.name)):
+            self.actuation_plan.invalidate(step_number)
         if (app.protocol and not app.running and not app.realtime_mode and
             (plugin == 'microdrop.gui.dmf_device_controller' or plugin ==
              self.name) and app.protocol.current_step_number == step_number):
@@ -418,10 +1017,17 @@ class OpenDropPlugin(Plugin, StepOptionsController, AppDataController):
         logger.debug('[OpenDropPlugin] on_step_swapped():'
                      'original_step_number=%d, new_step_number=%d' %
                      (original_step_number, new_step_number))
+        if self.actuation_plan is not None:
+            self.actuation_plan.invalidate(original_step_number)
+            self.actuation_plan.invalidate(new_step_number)
         self.on_step_options_changed(self.name,
                                      get_app().protocol.current_step_number)
 
     def on_experiment_log_changed(self, log):
+        if (self.actuation_log is None or self.actuation_log.path !=
+            self._actuation_log_path(log.get_log_path())):
+            self._open_actuation_log(log.get_log_path())
+
         # Check if the experiment log already has control board meta data, and
         # if so, return.
         data = log.get("control board name")
@@ -432,14 +1038,15 @@ class OpenDropPlugin(Plugin, StepOptionsController, AppDataController):
         # otherwise, add the name, hardware version, serial number,
         # and firmware version
         data = {}
-        if self.control_board.connected():
-            data["control board name"] = self.control_board.name()
+        if self.control_board.connected() and not self._flashing:
+            properties = self.board_worker.call('properties')
+            data["control board name"] = properties['name']
             data["control board serial number"] = \
                 self.control_board.serial_number
             data["control board hardware version"] = (self.control_board
                                                       .hardware_version())
-            data["control board software version"] = (self.control_board
-                                                      .software_version())
+            data["control board software version"] = (
+                properties['software_version'])
             # add info about the devices on the i2c bus
             try:
                 data["i2c devices"] = (self.control_board._i2c_devices)
@@ -447,6 +1054,45 @@ class OpenDropPlugin(Plugin, StepOptionsController, AppDataController):
                 pass
         log.add_data(data)
 
+    def on_app_exit(self):
+        self.watchdog.stop()
+        # wait for the log to be written before the process exits
+        self._close_actuation_log(timeout=None)
+
+    def _actuation_log_path(self, log_dir):
+        '''
+        Return the path of the actuation log in an experiment log directory.
+        Logs of a board map that drives more (or fewer) channels than a
+        single board are named after their channel count, since a log's
+        records have a fixed width.
+        '''
+        n_channels = self.number_of_channels()
+        if n_channels == self.control_board.number_of_channels():
+            name = 'opendrop_actuations.h5'
+        else:
+            name = 'opendrop_actuations-%dch.h5' % n_channels
+        return path(log_dir).joinpath(name)
+
+    def _open_actuation_log(self, log_dir):
+        '''
+        Close the actuation log (if any) and open the one in an experiment
+        log directory for the current channel count.
+        '''
+        self._close_actuation_log()
+        self.actuation_log = ActuationLogWriter(
+            self._actuation_log_path(log_dir),
+            n_channels=self.number_of_channels())
+
+    def _close_actuation_log(self, timeout=0):
+        '''
+        Close the actuation log. By default, this doesn't wait for the writer
+        thread (which may still have to index a large log) so that the main
+        loop isn't blocked.
+        '''
+        if self.actuation_log is not None:
+            self.actuation_log.close(timeout)
+            self.actuation_log = None
+
     def get_schedule_requests(self, function_name):
         """
         Returns a list of scheduling requests (i.e., ScheduleRequest
@@ -466,3 +1112,4 @@ class OpenDropPlugin(Plugin, StepOptionsController, AppDataController):
         return []
 
 PluginGlobals.pop_env()
+
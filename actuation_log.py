@@ -0,0 +1,251 @@
+"""
+Streaming log of the channel states applied to a board.
+
+Each applied step is appended to a chunked, compressed HDF5 table (one file
+per experiment). Records are written by a background thread, so appending a
+record never waits on disk. PyTables is only imported by the writer thread
+and by ActuationLogReader.
+"""
+import Queue
+import time
+import logging
+import threading
+
+import numpy as np
+
+from channel_map import N_CHANNELS
+from channel_state import ChannelState
+
+
+TABLE_NAME = 'actuations'
+FLUSH_INTERVAL = 1.0
+# used by PyTables to choose the chunk size
+EXPECTED_ROWS = 1000000
+
+
+def channel_bytes(n_channels):
+    '''
+    Return the number of bytes needed to pack the state of n_channels
+    channels.
+    '''
+    return (n_channels + 7) // 8
+
+
+def record_dtype(n_channels=N_CHANNELS):
+    '''
+    Return the record dtype of a log of the specified number of channels
+    (e.g., the channels of every board of a board map).
+    '''
+    return np.dtype([('timestamp', 'f8'), ('step', 'i4'),
+                     ('channels', 'u1', (channel_bytes(n_channels), )),
+                     ('voltage', 'f4'), ('frequency', 'f4'),
+                     ('latency', 'f4')])
+
+
+RECORD_DTYPE = record_dtype()
+
+
+def pack_channels(state, n_channels=N_CHANNELS):
+    '''
+    Pack a ChannelState (or channel state array) into a bitmask of
+    channel_bytes(n_channels) bytes.
+    '''
+    if not isinstance(state, ChannelState):
+        state = ChannelState.from_array(state)
+    return np.packbits(state.to_array(n_channels))
+
+
+def unpack_channels(channels, n_channels=N_CHANNELS):
+    '''
+    Return a boolean array (records x n_channels) from the packed channel
+    bitmasks of a set of records.
+    '''
+    return np.unpackbits(np.asarray(channels, dtype=np.uint8),
+                         axis=-1)[..., :n_channels].astype(bool)
+
+
+class ActuationLogWriter(object):
+    '''
+    Append-only actuation log, written from a background thread.
+
+    Records that could not be written (e.g., if PyTables is not available)
+    are counted in `dropped`.
+    '''
+    def __init__(self, path, flush_interval=FLUSH_INTERVAL,
+                 n_channels=N_CHANNELS):
+        '''
+        Parameters:
+            n_channels : number of channels of the device (sets the size of
+                the `channels` field)
+        '''
+        self.path = path
+        self.flush_interval = flush_interval
+        self.n_channels = n_channels
+        self.dtype = record_dtype(n_channels)
+        self.written = 0
+        self.dropped = 0
+        self._queue = Queue.Queue()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def append(self, step_number, state, voltage, frequency,
+               latency=np.nan, timestamp=None):
+        '''
+        Queue a record for writing.
+
+        Parameters:
+            step_number : protocol step
+            state : ChannelState applied
+            voltage : waveform voltage
+            frequency : waveform frequency (Hz)
+            latency : time (in seconds) taken to apply the step
+            timestamp : time the step was applied (defaults to now)
+        '''
+        if timestamp is None:
+            timestamp = time.time()
+        self._queue.put((timestamp, step_number,
+                         pack_channels(state, self.n_channels), voltage,
+                         frequency, latency))
+
+    def close(self, timeout=None):
+        '''
+        Write any queued records and close the file.
+
+        Parameters:
+            timeout : maximum time (in seconds) to wait for the writer thread
+                (None to wait until the file is closed); if the thread is
+                still running (e.g., indexing a large log), it finishes on
+                its own
+        '''
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def _next_records(self):
+        '''
+        Wait for the next records (up to the flush interval) and return them,
+        along with whether the log is being closed.
+        '''
+        try:
+            records = [self._queue.get(timeout=self.flush_interval)]
+        except Queue.Empty:
+            return [], False
+        while True:
+            try:
+                records.append(self._queue.get_nowait())
+            except Queue.Empty:
+                break
+        if None in records:
+            return records[:records.index(None)], True
+        return records, False
+
+    def _run(self):
+        self._write()
+        logging.info('[ActuationLog] wrote %d steps to %s (%d dropped)' %
+                     (self.written, self.path, self.dropped))
+
+    def _write(self):
+        try:
+            import tables
+
+            h5f = tables.open_file(self.path, mode='a')
+        except Exception, why:
+            logging.error('[ActuationLog] could not open %s: %s' %
+                          (self.path, why))
+            closing = False
+            while not closing:
+                records, closing = self._next_records()
+                self.dropped += len(records)
+            return
+
+        try:
+            if '/' + TABLE_NAME in h5f:
+                table = h5f.get_node('/' + TABLE_NAME)
+                if table.dtype != self.dtype:
+                    raise ValueError('the existing log has a different '
+                                     'number of channels')
+            else:
+                table = h5f.create_table(
+                    '/', TABLE_NAME, self.dtype, 'OpenDrop actuations',
+                    filters=tables.Filters(complevel=5, complib='zlib'),
+                    expectedrows=EXPECTED_ROWS)
+                table.attrs.n_channels = self.n_channels
+            last_flush = time.time()
+            closing = False
+            while not closing:
+                records, closing = self._next_records()
+                if records:
+                    table.append(np.array(records, dtype=self.dtype))
+                    self.written += len(records)
+                if closing or time.time() - last_flush >= self.flush_interval:
+                    table.flush()
+                    last_flush = time.time()
+            # index the columns used to slice the log
+            for column in (table.cols.step, table.cols.timestamp):
+                if not column.is_indexed:
+                    column.create_index()
+        except Exception, why:
+            logging.error('[ActuationLog] error writing %s: %s' %
+                          (self.path, why))
+        finally:
+            h5f.close()
+
+
+class ActuationLogReader(object):
+    '''
+    Read slices of an actuation log without loading the whole file.
+
+    Each method returns a structured array with the fields of
+    record_dtype(n_channels); use unpack_channels(records['channels'],
+    reader.n_channels) to expand the `channels` field.
+    '''
+    def __init__(self, path):
+        import tables
+
+        self.path = path
+        self._h5f = tables.open_file(path, mode='r')
+        self.table = self._h5f.get_node('/' + TABLE_NAME)
+        if 'n_channels' in self.table.attrs:
+            self.n_channels = int(self.table.attrs.n_channels)
+        else:
+            self.n_channels = N_CHANNELS
+
+    def __len__(self):
+        return self.table.nrows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._h5f.close()
+
+    def read(self, start=None, stop=None):
+        '''
+        Return the records in the specified row range.
+        '''
+        return self.table.read(start, stop)
+
+    def read_steps(self, start, stop=None):
+        '''
+        Return the records of steps start <= step < stop (or of step `start`
+        only if stop is None).
+        '''
+        if stop is None:
+            stop = start + 1
+        return self.table.read_where('(step >= start) & (step < stop)',
+                                     {'start': start, 'stop': stop})
+
+    def read_time(self, start, stop=None):
+        '''
+        Return the records with start <= timestamp < stop (or with
+        timestamp >= start if stop is None).
+        '''
+        if stop is None:
+            return self.table.read_where('timestamp >= start',
+                                         {'start': start})
+        return self.table.read_where('(timestamp >= start) & '
+                                     '(timestamp < stop)',
+                                     {'start': start, 'stop': stop})
@@ -0,0 +1,226 @@
+"""
+Ahead-of-time compilation of a protocol into pin-level actuations.
+"""
+import numpy as np
+
+from channel_map import N_PINS, multiplex_frames, state_to_pin_levels
+from channel_state import ChannelState
+
+
+def validate_waveforms(voltages, frequencies, max_voltage=None,
+                       min_frequency=None, max_frequency=None):
+    '''
+    Check the waveform of every step of a protocol against the board limits.
+
+    Parameters:
+        voltages : sequence of step voltages
+        frequencies : sequence of step frequencies (Hz)
+        max_voltage, min_frequency, max_frequency : board limits (None to
+            skip the corresponding check)
+
+    Returns:
+        list of (step_number, message) tuples, sorted by step number
+    '''
+    voltages = np.asarray(voltages, dtype=float)
+    frequencies = np.asarray(frequencies, dtype=float)
+    errors = []
+    if max_voltage is not None:
+        for i in np.flatnonzero(voltages > max_voltage):
+            errors.append((int(i), 'Voltage exceeds the maximum value '
+                           '(%d V).' % max_voltage))
+    if min_frequency is not None and max_frequency is not None:
+        invalid = ((frequencies < min_frequency) |
+                   (frequencies > max_frequency))
+        for i in np.flatnonzero(invalid):
+            errors.append((int(i), 'Frequency is outside of the valid '
+                           'range (%.1f - %.1f Hz).' % (min_frequency,
+                                                        max_frequency)))
+    return sorted(errors, key=lambda error: error[0])
+
+
+class StepPlan(object):
+    '''
+    Compiled actuation for a single protocol step.
+
+    Attributes:
+        duration : step duration in ms
+        voltage : waveform voltage
+        frequency : waveform frequency in Hz
+        state : ChannelState with the channels to actuate
+        shard_frames : list with the frames of each board, where the frames
+            of a board are a list of ChannelStates (numbered from the board's
+            first channel) to apply (cycled if more than one)
+        duty_cycle : fraction of the step each channel is actuated
+        shard_pin_levels : list with an array of the pin level vector of each
+            frame for each board
+        errors : list of channel problems found while compiling the step
+
+    `frames` and `pin_levels` are those of the first (or only) board.
+    '''
+    def __init__(self, duration, voltage, frequency, state, shard_frames,
+                 duty_cycle, errors):
+        self.duration = duration
+        self.voltage = voltage
+        self.frequency = frequency
+        self.state = state
+        self.shard_frames = shard_frames
+        self.duty_cycle = duty_cycle
+        self.shard_pin_levels = [np.array([state_to_pin_levels(frame)[0]
+                                           for frame in frames])
+                                 for frames in shard_frames]
+        self.errors = errors
+
+    @property
+    def frames(self):
+        return self.shard_frames[0]
+
+    @property
+    def pin_levels(self):
+        return self.shard_pin_levels[0]
+
+
+class ActuationPlan(object):
+    '''
+    Actuation plan for a whole protocol, compiled from each step's options
+    and channel states before the protocol runs.
+
+    Steps can be invalidated individually (e.g., when their options change)
+    and recompiled on demand; get() returns None for invalid steps.
+
+    If the channels are spread over several boards, `shards` is a list of
+    the (first_channel, n_channels) range of each board, and each step is
+    compiled into separate frames for each board.
+    '''
+    def __init__(self, n_channels, max_voltage=None, min_frequency=None,
+                 max_frequency=None, shards=None):
+        self.n_channels = n_channels
+        self.max_voltage = max_voltage
+        self.min_frequency = min_frequency
+        self.max_frequency = max_frequency
+        if shards is None:
+            shards = [(0, n_channels)]
+        self.shards = shards
+        self.steps = []
+
+    def __len__(self):
+        return len(self.steps)
+
+    def compile(self, steps):
+        '''
+        Compile a protocol.
+
+        Parameters:
+            steps : list of (options, state_of_channels) tuples, where options
+                is a dictionary of step options (duration, voltage and
+                frequency)
+        '''
+        self.steps = [self.compile_step(options, state)
+                      for options, state in steps]
+
+    def compile_step(self, options, state):
+        '''
+        Compile a single step and return its StepPlan.
+        '''
+        errors = []
+        state = ChannelState.from_array(state)
+        extra = ChannelState(state.bits >> self.n_channels << self.n_channels)
+        if extra:
+            errors.append('Channels %s exceed the number of channels on the '
+                          'board (%d).' % (list(extra), self.n_channels))
+            state -= extra
+        shard_frames = []
+        duty_cycle = np.zeros(self.n_channels)
+        unconnected = state
+        for first_channel, n_channels in self.shards:
+            frames, shard_duty_cycle = multiplex_frames(
+                state.slice(first_channel, n_channels))
+            shard_frames.append(frames)
+            duty_cycle[first_channel:first_channel + n_channels] = \
+                shard_duty_cycle[:n_channels]
+            unconnected -= ChannelState(((1 << n_channels) - 1) <<
+                                        first_channel)
+        if unconnected:
+            errors.append('Channels %s are not connected to any board.' %
+                          list(unconnected))
+        return StepPlan(options['duration'], options['voltage'],
+                        options['frequency'], state, shard_frames,
+                        duty_cycle, errors)
+
+    def update_step(self, step_number, options, state):
+        '''
+        Recompile a single step and return its StepPlan.
+        '''
+        self.steps[step_number] = self.compile_step(options, state)
+        return self.steps[step_number]
+
+    def invalidate(self, step_number=None):
+        '''
+        Mark a step (or, if step_number is None, every step) as invalid.
+        '''
+        if step_number is None:
+            self.steps = [None] * len(self.steps)
+        elif 0 <= step_number < len(self.steps):
+            self.steps[step_number] = None
+
+    def get(self, step_number):
+        if 0 <= step_number < len(self.steps):
+            return self.steps[step_number]
+        return None
+
+    def errors(self):
+        '''
+        Return a list of (step_number, message) tuples for every problem
+        found in the valid steps of the plan.
+        '''
+        valid = [i for i, step in enumerate(self.steps) if step is not None]
+        waveform_errors = validate_waveforms(
+            [self.steps[i].voltage for i in valid],
+            [self.steps[i].frequency for i in valid], self.max_voltage,
+            self.min_frequency, self.max_frequency)
+        errors = [(i, error) for i in valid for error in self.steps[i].errors]
+        errors += [(valid[j], error) for j, error in waveform_errors]
+        return sorted(errors, key=lambda error: error[0])
+
+    def durations(self):
+        '''
+        Return an array of step durations in ms (NaN for invalid steps).
+        '''
+        return np.array([np.nan if step is None else step.duration
+                         for step in self.steps], dtype=float)
+
+    def deadlines(self):
+        '''
+        Return an array with the time (in ms, from the start of the protocol)
+        at which each step should end.
+        '''
+        return np.cumsum(self.durations())
+
+    def waveform_changes(self):
+        '''
+        Return a boolean array that is True for each step whose voltage or
+        frequency differs from the previous step.
+        '''
+        waveforms = [None if step is None else (step.voltage, step.frequency)
+                     for step in self.steps]
+        return np.array([i == 0 or waveforms[i] is None or
+                         waveforms[i] != waveforms[i - 1]
+                         for i in range(len(waveforms))], dtype=bool)
+
+    def pin_deltas(self):
+        '''
+        Return a boolean array (steps x (boards * N_PINS)) that is True for
+        each pin whose level in the first frame of a step differs from its
+        level in the last frame of the previous step (all pins for the first
+        step and for steps following an invalid step). Columns
+        k * N_PINS to (k + 1) * N_PINS - 1 are the pins of board k.
+        '''
+        deltas = np.ones((len(self.steps), len(self.shards) * N_PINS),
+                         dtype=bool)
+        for i in range(1, len(self.steps)):
+            previous, step = self.steps[i - 1], self.steps[i]
+            if previous is not None and step is not None:
+                deltas[i] = np.concatenate([
+                    levels[0] != previous_levels[-1]
+                    for levels, previous_levels in
+                    zip(step.shard_pin_levels, previous.shard_pin_levels)])
+        return deltas
@@ -0,0 +1,389 @@
+"""
+Benchmarks for the OpenDrop actuation path.
+
+The benchmarks run against a simulated board (see simulator.py), so they do
+not need any hardware:
+
+    set_state_sparse, set_state_dense : steps/second through
+        OpenDropBoard.set_state_of_all_channels for a single moving electrode
+        and for alternating blocks of electrode rows
+    connect : time to connect to the board
+    validate_waveforms : time to validate the waveforms of a large protocol
+    compile_plan : time to compile a large protocol into an actuation plan
+    step_drift : timing drift of a long synthetic protocol driven through
+        OpenDropPlugin.on_step_run (requires MicroDrop)
+
+Results are written as JSON and can be compared against a stored baseline:
+
+    python benchmark.py --output results.json --baseline baseline.json
+
+exits with status 1 if any metric is worse than the baseline by more than the
+tolerance. Use --save-baseline to store the results as the new baseline.
+"""
+import os
+import sys
+import imp
+import json
+import time
+import logging
+import argparse
+import platform
+
+import numpy as np
+
+from opendrop_board import OpenDropBoard
+from actuation_plan import ActuationPlan, validate_waveforms
+from channel_map import N_CHANNELS, CHANNEL_GATE
+from step_timer import monotonic
+
+
+DEFAULT_PORT = 'sim://'
+DEFAULT_BASELINE = 'benchmark_baseline.json'
+DEFAULT_TOLERANCE = 0.25
+# smallest absolute change in a metric that counts as a regression, so that
+# noise in metrics close to zero (e.g., the drift of a protocol that keeps to
+# its schedule) isn't reported as a huge relative change
+MIN_CHANGES = {'final_drift_ms': 5., 'max_drift_ms': 5.,
+               'wall_clock_error_ms': 10.}
+# default for the other metrics in milliseconds
+MIN_CHANGE_MS = 0.5
+
+
+def _latency_summary(latencies):
+    latencies = np.asarray(latencies, dtype=float) * 1e3
+    p50, p95 = np.percentile(latencies, [50, 95])
+    return {'mean_ms': latencies.mean(), 'p50_ms': p50, 'p95_ms': p95}
+
+
+def _connected_board(port):
+    board = OpenDropBoard()
+    board.connect(port)
+    return board
+
+
+def _run_states(board, states):
+    start = monotonic()
+    for state in states:
+        board.set_state_of_all_channels(state)
+    elapsed = monotonic() - start
+    return {'steps_per_second': len(states) / elapsed,
+            'mean_ms': elapsed / len(states) * 1e3}
+
+
+def bench_set_state_sparse(port, n_steps):
+    '''
+    Move a single electrode across every channel.
+    '''
+    states = np.zeros((n_steps, N_CHANNELS), dtype=int)
+    states[np.arange(n_steps), np.arange(n_steps) % N_CHANNELS] = 1
+    board = _connected_board(port)
+    try:
+        return _run_states(board, states)
+    finally:
+        board.disconnect()
+
+
+def bench_set_state_dense(port, n_steps):
+    '''
+    Alternate between the even and the odd electrode rows (every gate pin
+    changes on each step).
+    '''
+    even = (CHANNEL_GATE % 2 == 0).astype(int)
+    states = [even if i % 2 == 0 else 1 - even for i in range(n_steps)]
+    board = _connected_board(port)
+    try:
+        return _run_states(board, states)
+    finally:
+        board.disconnect()
+
+
+def bench_connect(port, n_connects):
+    board = OpenDropBoard()
+    latencies = []
+    for i in range(n_connects):
+        start = monotonic()
+        board.connect(port)
+        latencies.append(monotonic() - start)
+        board.disconnect()
+    return _latency_summary(latencies)
+
+
+def bench_validate_waveforms(n_steps, repeats=10):
+    voltages = np.random.uniform(0, 200, n_steps)
+    frequencies = np.random.uniform(0, 20e3, n_steps)
+    latencies = []
+    for i in range(repeats):
+        start = monotonic()
+        validate_waveforms(voltages, frequencies, 150, 100, 10e3)
+        latencies.append(monotonic() - start)
+    return _latency_summary(latencies)
+
+
+def bench_compile_plan(n_steps):
+    steps = []
+    for i in range(n_steps):
+        state = np.zeros(N_CHANNELS, dtype=int)
+        state[np.random.choice(N_CHANNELS, 3, replace=False)] = 1
+        steps.append(({'duration': 100, 'voltage': 100,
+                       'frequency': 10e3}, state))
+    plan = ActuationPlan(N_CHANNELS, 150, 100, 10e3)
+    start = monotonic()
+    plan.compile(steps)
+    compile_time = monotonic() - start
+    start = monotonic()
+    plan.errors()
+    return {'total_ms': compile_time * 1e3,
+            'per_step_ms': compile_time / n_steps * 1e3,
+            'errors_ms': (monotonic() - start) * 1e3}
+
+
+class _SyntheticProtocol(object):
+    def __init__(self, n_steps):
+        # the plugin tracks steps by identity
+        self.steps = [object() for i in range(n_steps)]
+        self.current_step_number = 0
+
+
+class _SyntheticStepOptions(object):
+    def __init__(self, state_of_channels):
+        self.state_of_channels = state_of_channels
+
+
+class _SyntheticDevice(object):
+    def max_channel(self):
+        return N_CHANNELS - 1
+
+
+class _SyntheticApp(object):
+    '''
+    The parts of the MicroDrop app used by OpenDropPlugin while running a
+    protocol.
+    '''
+    realtime_mode = False
+
+    def __init__(self, protocol, states):
+        self.protocol = protocol
+        self.states = states
+        self.running = True
+        self.dmf_device = _SyntheticDevice()
+        self.dmf_device_controller = self
+
+    def get_step_options(self, step_number):
+        return _SyntheticStepOptions(self.states[step_number])
+
+
+def bench_step_drift(port, n_steps, duration):
+    '''
+    Run a synthetic protocol through OpenDropPlugin.on_step_run (outside of
+    MicroDrop) and measure how far step starts drift from their schedule.
+
+    Parameters:
+        port : port of the (simulated) board
+        n_steps : number of protocol steps
+        duration : duration of each step in ms
+    '''
+    import gobject
+
+    plugin_module = imp.load_package('opendrop_plugin',
+                                     os.path.dirname(os.path.abspath(
+                                         __file__)))
+    states = [np.roll(np.eye(1, N_CHANNELS, dtype=int)[0], i)
+              for i in range(n_steps)]
+    app = _SyntheticApp(_SyntheticProtocol(n_steps), states)
+    loop = gobject.MainLoop()
+    plugin = plugin_module.OpenDropPlugin()
+
+    def next_step():
+        if app.protocol.current_step_number + 1 < n_steps:
+            app.protocol.current_step_number += 1
+            plugin.on_step_run()
+        else:
+            loop.quit()
+        return False
+
+    def emit_signal(function, args=None, interface=None):
+        if args is None:
+            args = []
+        elif not isinstance(args, list):
+            args = [args]
+        if function in ('set_voltage', 'set_frequency', 'on_step_complete'):
+            getattr(plugin, function)(*args)
+        if function == 'on_step_complete':
+            gobject.idle_add(next_step)
+
+    plugin.get_step_options = lambda step_number: {
+        'duration': duration, 'voltage': 100, 'frequency': 10e3}
+    plugin.get_app_values = lambda: {'multiplex_refresh_rate': 25}
+    patched = {'get_app': lambda: app, 'emit_signal': emit_signal}
+    originals = dict((name, getattr(plugin_module, name))
+                     for name in patched)
+    for name, value in patched.items():
+        setattr(plugin_module, name, value)
+    try:
+        plugin.board_worker.call('connect', port)
+        plugin.on_protocol_run()
+        start = monotonic()
+        gobject.idle_add(plugin.on_step_run)
+        loop.run()
+        elapsed = monotonic() - start
+        plugin.board_worker.call('disconnect')
+    finally:
+        for name, value in originals.items():
+            setattr(plugin_module, name, value)
+        plugin.board_worker.stop()
+        plugin.watchdog.stop()
+
+    records = plugin.step_timer.records
+    drift = np.array([record.actual_start - record.planned_start
+                      for record in records]) * 1e3
+    actuation = plugin.actuation_stats.summary()['step_actuation']
+    return {'final_drift_ms': drift[-1],
+            'max_drift_ms': drift.max(),
+            'wall_clock_error_ms': elapsed * 1e3 - n_steps * duration,
+            'actuation_p50_ms': actuation['p50'],
+            'actuation_p95_ms': actuation['p95']}
+
+
+def run_benchmarks(port=DEFAULT_PORT, n_steps=500, n_protocol_steps=20000,
+                   n_drift_steps=2000, step_duration=20, only=None):
+    '''
+    Run the benchmarks.
+
+    Parameters:
+        port : port of the (simulated) board
+        n_steps : number of states to apply in the set_state benchmarks
+        n_protocol_steps : number of steps of the protocols validated and
+            compiled
+        n_drift_steps : number of steps of the step_drift protocol
+        step_duration : duration (in ms) of each step_drift step
+        only : list of the names of the benchmarks to run (default: all)
+
+    Returns:
+        dictionary mapping each benchmark name to a dictionary of metrics
+        (None if the benchmark could not run)
+    '''
+    benchmarks = [
+        ('set_state_sparse', lambda: bench_set_state_sparse(port, n_steps)),
+        ('set_state_dense', lambda: bench_set_state_dense(port, n_steps)),
+        ('connect', lambda: bench_connect(port, 10)),
+        ('validate_waveforms',
+         lambda: bench_validate_waveforms(n_protocol_steps)),
+        ('compile_plan', lambda: bench_compile_plan(n_protocol_steps)),
+        ('step_drift', lambda: bench_step_drift(port, n_drift_steps,
+                                                step_duration)),
+    ]
+    results = {}
+    for name, benchmark in benchmarks:
+        if only and name not in only:
+            continue
+        logging.info('[benchmark] running %s' % name)
+        try:
+            results[name] = benchmark()
+        except ImportError, why:
+            logging.warning('[benchmark] skipping %s: %s' % (name, why))
+            results[name] = None
+    return results
+
+
+def higher_is_better(metric):
+    return metric.endswith('_per_second')
+
+
+def min_change(metric):
+    if metric in MIN_CHANGES:
+        return MIN_CHANGES[metric]
+    return MIN_CHANGE_MS if metric.endswith('_ms') else 0.
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    '''
+    Compare benchmark results against a baseline.
+
+    Returns:
+        list of (benchmark, metric, baseline value, value, relative change)
+        tuples for the metrics that are worse than the baseline by more than
+        the tolerance and by more than the metric's minimum change (see
+        MIN_CHANGES; the relative change is positive when worse)
+    '''
+    regressions = []
+    for name, metrics in sorted(results.items()):
+        reference = baseline.get(name)
+        if not metrics or not reference:
+            continue
+        for metric, value in sorted(metrics.items()):
+            if metric not in reference:
+                continue
+            previous = abs(reference[metric])
+            difference = abs(value) - previous
+            if higher_is_better(metric):
+                difference = -difference
+            change = float(difference) / max(previous, 1e-9)
+            if change > tolerance and difference > min_change(metric):
+                regressions.append((name, metric, reference[metric], value,
+                                    change))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--port', default=DEFAULT_PORT,
+                        help='board port (default: %(default)s)')
+    parser.add_argument('--steps', type=int, default=500,
+                        help='states applied in the set_state benchmarks')
+    parser.add_argument('--protocol-steps', type=int, default=20000,
+                        help='steps of the validated/compiled protocols')
+    parser.add_argument('--drift-steps', type=int, default=2000,
+                        help='steps of the step_drift protocol')
+    parser.add_argument('--step-duration', type=int, default=20,
+                        help='duration of each step_drift step (ms)')
+    parser.add_argument('--only', nargs='+', help='benchmarks to run')
+    parser.add_argument('--output', help='write the results to this file')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE,
+                        help='baseline to compare against '
+                        '(default: %(default)s)')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='relative change in a metric that counts as a '
+                        'regression (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    # keep the plugin's per-step messages out of the measurements
+    logging.getLogger('microdrop').setLevel(logging.WARNING)
+
+    results = run_benchmarks(args.port, args.steps, args.protocol_steps,
+                             args.drift_steps, args.step_duration, args.only)
+    document = {'timestamp': time.time(),
+                'platform': platform.platform(),
+                'python': platform.python_version(),
+                'port': args.port,
+                'results': results}
+    output = json.dumps(document, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print output
+
+    regressions = []
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        for name, metric, previous, value, change in regressions:
+            logging.error('[benchmark] %s.%s regressed by %.0f%% '
+                          '(%.3f -> %.3f)' % (name, metric, 100 * change,
+                                              previous, value))
+        if not regressions:
+            logging.info('[benchmark] no regressions against %s' %
+                         args.baseline)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            f.write(output)
+        logging.info('[benchmark] saved baseline to %s' % args.baseline)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
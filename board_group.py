@@ -0,0 +1,96 @@
+"""
+Support for devices whose channels are spread over several OpenDrop boards.
+
+Each board (shard) drives a contiguous range of the device's channels and has
+its own BoardWorker, so channel states can be applied to every board
+concurrently.
+"""
+import re
+import threading
+
+from channel_map import N_CHANNELS
+
+
+def parse_board_map(board_map):
+    '''
+    Parse a board map of the form "0-67:COM3, 68-135:COM4", assigning
+    (inclusive) channel ranges to the board on each port.
+
+    Returns:
+        list of (first_channel, n_channels, port) tuples, sorted by first
+        channel (empty if the map is empty)
+
+    Raises:
+        ValueError : if an entry is malformed, a range exceeds the number of
+            channels of a board, or ranges or ports are repeated
+    '''
+    shards = []
+    for entry in (board_map or '').split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        match = re.match(r'^(\d+)\s*-\s*(\d+)\s*:\s*(\S+)$', entry)
+        if match is None:
+            raise ValueError('Invalid board map entry "%s" (expected '
+                             '<first channel>-<last channel>:<port>).' %
+                             entry)
+        first, last = int(match.group(1)), int(match.group(2))
+        if not 0 < last - first + 1 <= N_CHANNELS:
+            raise ValueError('Invalid channel range %d-%d (each board drives '
+                             'up to %d channels).' % (first, last,
+                                                      N_CHANNELS))
+        shards.append((first, last - first + 1, match.group(3)))
+    shards.sort()
+    for (first, n_channels, port), (next_first, _, next_port) in \
+            zip(shards, shards[1:]):
+        if first + n_channels > next_first:
+            raise ValueError('The channel ranges of %s and %s overlap.' %
+                             (port, next_port))
+    ports = [port for first, n_channels, port in shards]
+    if len(set(ports)) != len(ports):
+        raise ValueError('Each port can only appear once in the board map.')
+    return shards
+
+
+class BoardShard(object):
+    '''
+    A board (and the worker that owns it) driving channels first_channel to
+    first_channel + n_channels - 1 of the device.
+    '''
+    def __init__(self, first_channel, n_channels, board, worker, port=None):
+        self.first_channel = first_channel
+        self.n_channels = n_channels
+        self.board = board
+        self.worker = worker
+        self.port = port
+
+    def __repr__(self):
+        return ('BoardShard(channels=%d-%d, port=%s)' %
+                (self.first_channel, self.first_channel + self.n_channels - 1,
+                 self.port))
+
+
+class Barrier(object):
+    '''
+    Completion callback shared by several commands.
+
+    The barrier is called as `barrier(value, error)` by each command (e.g.,
+    as a BoardWorker callback) and calls `callback(None, error)` once all
+    `n` commands have completed, where error is the first error reported
+    (or None).
+    '''
+    def __init__(self, n, callback):
+        self.remaining = n
+        self.error = None
+        self.callback = callback
+        self._lock = threading.Lock()
+
+    def __call__(self, value, error):
+        with self._lock:
+            if self.error is None:
+                self.error = error
+            self.remaining -= 1
+            done = self.remaining == 0
+        if done:
+            return self.callback(None, self.error)
+        return False
@@ -0,0 +1,256 @@
+"""
+Background thread that owns all serial communication with an OpenDrop board.
+"""
+import logging
+import threading
+import Queue
+
+from channel_map import as_channel_state, state_to_pin_levels
+from step_timer import monotonic
+
+
+# headroom left above the measured time needed to switch frames when the
+# refresh rate has to be lowered
+FRAME_PERIOD_MARGIN = 1.25
+
+
+class CommandResult(object):
+    '''
+    Holds the outcome of a command executed by a BoardWorker.
+    '''
+    def __init__(self):
+        self.value = None
+        self.error = None
+        self.superseded = False
+        self._done = threading.Event()
+
+    def wait(self, timeout=None):
+        self._done.wait(timeout)
+        return self._done.is_set()
+
+
+class BoardWorker(threading.Thread):
+    '''
+    Thread that executes board commands from a queue so that the caller
+    (e.g., the GTK main loop) never blocks on serial I/O.
+
+    Channel state updates that are superseded by a newer update before they
+    have been applied are dropped. If a channel state needs to be split into
+    several multiplexed frames, the worker cycles through them until the next
+    state update arrives. If switching frames takes longer than the frame
+    period, the refresh rate is lowered so that each frame is still held for
+    (at least) the time needed to write it.
+
+    Completion callbacks are invoked through `dispatch` (e.g.,
+    `gobject.idle_add` to run them in the main loop). They are called as
+    `callback(value, error)`, where error is the exception raised by the
+    command (or None).
+    '''
+    def __init__(self, board, dispatch=None):
+        super(BoardWorker, self).__init__(name='OpenDropBoardWorker')
+        self.daemon = True
+        self.board = board
+        if dispatch is None:
+            dispatch = lambda callback, *args: callback(*args)
+        self.dispatch = dispatch
+        self.superseded_count = 0
+        self._queue = Queue.Queue()
+        self._frames = []
+        self._pin_levels = []
+        self._refresh_rate = None
+        self._frame_index = 0
+        self._frame_period = None
+        self._next_frame_time = None
+        # refresh rate actually used for the current frames (lower than the
+        # requested one if the board cannot switch frames fast enough)
+        self.effective_refresh_rate = None
+
+    def submit(self, method, *args, **kwargs):
+        '''
+        Queue a call to the specified board method and return immediately.
+
+        Parameters:
+            method : name of the OpenDropBoard method to call
+            callback : optional function called with (value, error) once the
+                method has returned
+
+        Returns:
+            CommandResult for the call
+        '''
+        return self._put('call', (method, args), kwargs.get('callback'))
+
+    def call(self, method, *args):
+        '''
+        Call the specified board method from the worker thread and wait for
+        it to return, re-raising any exception it raised.
+        '''
+        if threading.current_thread() is self:
+            return getattr(self.board, method)(*args)
+        result = self._put('call', (method, args), None)
+        result.wait()
+        if result.error is not None:
+            raise result.error
+        return result.value
+
+    def set_state(self, frames, refresh_rate=None, callback=None,
+                  step_number=None, pin_levels=None):
+        '''
+        Queue a channel state update.
+
+        Parameters:
+            frames : list of ChannelStates (or channel state arrays); if
+                there is more than one frame, the worker cycles through them
+            refresh_rate : number of complete cycles through all frames per
+                second (required if there is more than one frame)
+            callback : optional function called with (None, error) once the
+                first frame has been applied to the board
+            step_number : protocol step recorded in the board's actuation
+                trace for this state (None outside of a protocol)
+            pin_levels : optional pin level vector of each frame (e.g., from
+                a compiled StepPlan); computed from the frames if omitted
+
+        Returns:
+            CommandResult for the update
+        '''
+        if pin_levels is not None:
+            pin_levels = list(pin_levels)
+        return self._put('state', (list(frames), refresh_rate, step_number,
+                                   pin_levels), callback)
+
+    def restore_state(self, callback=None):
+        '''
+        Queue the reapplication of the last channel state (e.g., after the
+        board has been reconnected).
+
+        Returns:
+            CommandResult for the update
+        '''
+        return self._put('restore', None, callback)
+
+    def stop(self):
+        self._put('stop', None, None)
+        self.join()
+
+    def _put(self, kind, payload, callback):
+        result = CommandResult()
+        self._queue.put((kind, payload, callback, result))
+        return result
+
+    def run(self):
+        while True:
+            commands = self._next_commands()
+            if commands is None:
+                self._apply_next_frame()
+                continue
+
+            # only the most recent state update needs to be applied
+            states = [i for i, command in enumerate(commands)
+                      if command[0] == 'state']
+            for i, (kind, payload, callback, result) in enumerate(commands):
+                if kind == 'stop':
+                    return
+                if kind == 'state' and i != states[-1]:
+                    self.superseded_count += 1
+                    result.superseded = True
+                    result._done.set()
+                    continue
+                try:
+                    if kind == 'state':
+                        result.value = self._apply_state(*payload)
+                    elif kind == 'restore':
+                        if self._frames:
+                            self._apply_state(self._frames,
+                                              self._refresh_rate,
+                                              self.board.trace.step_number,
+                                              self._pin_levels)
+                    else:
+                        method, args = payload
+                        result.value = getattr(self.board, method)(*args)
+                except Exception, why:
+                    logging.error('[BoardWorker] %s failed: %s' %
+                                  (kind if kind != 'call' else payload[0],
+                                   why))
+                    result.error = why
+                result._done.set()
+                if callback is not None:
+                    self.dispatch(callback, result.value, result.error)
+
+    def _next_commands(self):
+        '''
+        Wait for the next command (or until the next multiplexed frame is
+        due) and return it along with any other commands already queued.
+        Returns None if the next frame is due and no command is queued.
+        '''
+        timeout = None
+        if self._next_frame_time is not None:
+            timeout = self._next_frame_time - monotonic()
+        try:
+            if timeout is not None and timeout <= 0:
+                # don't let frames that take longer than the frame period
+                # starve the queue
+                commands = [self._queue.get_nowait()]
+            else:
+                commands = [self._queue.get(timeout=timeout)]
+        except Queue.Empty:
+            return None
+        while True:
+            try:
+                commands.append(self._queue.get_nowait())
+            except Queue.Empty:
+                return commands
+
+    def _apply_state(self, frames, refresh_rate, step_number, pin_levels):
+        self.board.trace.step_number = step_number
+        self._frames = frames
+        self._refresh_rate = refresh_rate
+        self._frame_index = 0
+        self._next_frame_time = None
+        self.effective_refresh_rate = None
+        if pin_levels is None:
+            # convert the frames once, rather than every time they are cycled
+            self.board.set_state_of_all_channels(frames[0])
+            pin_levels = [state_to_pin_levels(as_channel_state(frame))[0]
+                          for frame in frames]
+        else:
+            self.board.apply_pin_levels(pin_levels[0])
+        self._pin_levels = pin_levels
+        if len(frames) > 1:
+            self.effective_refresh_rate = refresh_rate
+            self._frame_period = 1.0 / (refresh_rate * len(frames))
+            self._next_frame_time = monotonic() + self._frame_period
+
+    def _apply_next_frame(self):
+        if not self.board.connected():
+            self._next_frame_time = None
+            return
+        self._frame_index = (self._frame_index + 1) % len(self._frames)
+        # don't try to catch up on frames missed while the worker was busy
+        self._next_frame_time = max(self._next_frame_time + self._frame_period,
+                                    monotonic())
+        start = monotonic()
+        try:
+            self.board.apply_pin_levels(self._pin_levels[self._frame_index])
+        except Exception, why:
+            logging.error('[BoardWorker] multiplexing stopped: %s' % why)
+            self._next_frame_time = None
+            return
+        switch_time = monotonic() - start
+        if switch_time > self._frame_period:
+            self._lower_refresh_rate(switch_time)
+
+    def _lower_refresh_rate(self, switch_time):
+        '''
+        Lengthen the frame period beyond the time needed to switch frames
+        (otherwise the frames that are slowest to write would be held longer
+        than the others, skewing the duty cycles).
+        '''
+        frame_period = self._frame_period
+        self._frame_period = switch_time * FRAME_PERIOD_MARGIN
+        self._next_frame_time = monotonic() + self._frame_period
+        refresh_rate = 1.0 / (self._frame_period * len(self._frames))
+        logging.warning('[BoardWorker] switching frames took %.1f ms (frame '
+                        'period: %.1f ms); lowering the refresh rate from '
+                        '%.1f Hz to %.1f Hz' %
+                        (switch_time * 1e3, frame_period * 1e3,
+                         self.effective_refresh_rate, refresh_rate))
+        self.effective_refresh_rate = refresh_rate
@@ -0,0 +1,164 @@
+"""
+Mapping between OpenDrop channels and the gate/source pins of its electrode
+multiplexer.
+
+Each channel is addressed by one gate (G0-G8) and one source (S1-S8). A
+channel is actuated when its gate pin is driven high and its source pin is
+driven low.
+"""
+import numpy as np
+
+from channel_state import ChannelState
+
+
+LOW = 0
+HIGH = 1
+
+N_CHANNELS = 68
+
+# gate pins G0-G8 are wired to digital pins 2-10 and source pins S1-S8 to
+# digital pins 11-18
+GATE_PIN_OFFSET = 2
+SOURCE_PIN_OFFSET = 10
+N_GATES = 9
+N_SOURCES = 8
+
+# all gate and source pins form a contiguous block of digital pins (2-18);
+# pin level vectors are indexed relative to the first pin of this block
+FIRST_PIN = GATE_PIN_OFFSET
+N_PINS = N_GATES + N_SOURCES
+
+_channels = np.arange(N_CHANNELS)
+
+# gate and source index of each channel (the first four channels share G0)
+CHANNEL_GATE = np.where(_channels < 4, 0, (_channels - 4) // 8 + 1)
+CHANNEL_SOURCE = np.where(_channels < 2, 2 * _channels + 1,
+                          np.where(_channels < 4, 2 * _channels + 2,
+                                   (_channels - 4) % 8 + 1))
+
+# digital pin of each channel's gate and source
+CHANNEL_GATE_PIN = GATE_PIN_OFFSET + CHANNEL_GATE
+CHANNEL_SOURCE_PIN = SOURCE_PIN_OFFSET + CHANNEL_SOURCE
+
+# level vector with all channels off (all gates low and all sources high)
+CLEARED_PIN_LEVELS = np.array([LOW] * N_GATES + [HIGH] * N_SOURCES,
+                              dtype=np.uint8)
+
+
+# bitmask of the channels on each gate and on each source
+GATE_CHANNELS = [ChannelState.from_array(CHANNEL_GATE == gate).bits
+                 for gate in range(N_GATES)]
+SOURCE_CHANNELS = [ChannelState.from_array(CHANNEL_SOURCE == source).bits
+                   for source in range(N_SOURCES + 1)]
+
+_CHANNEL_GATE_BIT = [1 << int(gate) for gate in CHANNEL_GATE]
+_CHANNEL_SOURCE_BIT = [1 << int(source) for source in CHANNEL_SOURCE]
+_PIN_SHIFTS = np.arange(N_PINS)
+_SOURCE_PIN_MASK = (1 << N_SOURCES) - 1
+
+
+def as_channel_state(state):
+    '''
+    Return a ChannelState for a ChannelState or a sequence of up to
+    N_CHANNELS channel states.
+    '''
+    if not isinstance(state, ChannelState):
+        state = ChannelState.from_array(state)
+    if state.bits >> N_CHANNELS:
+        raise ValueError('Channel %d is out of range (%d channels).' %
+                         (state.max_channel(), N_CHANNELS))
+    return state
+
+
+def _union(masks, selected):
+    '''
+    Return the union of the masks selected by the bits of `selected`.
+    '''
+    bits = 0
+    for i in ChannelState(selected):
+        bits |= masks[i]
+    return bits
+
+
+def state_to_pin_levels(state):
+    '''
+    Convert a channel state into a pin level vector.
+
+    Parameters:
+        state : ChannelState or sequence of up to N_CHANNELS channel states
+
+    Returns:
+        (levels, unrepresentable) tuple, where levels is an array of N_PINS
+        levels (levels[i] is the level of digital pin FIRST_PIN + i) and
+        unrepresentable is a ChannelState with the channels whose requested
+        state cannot be produced by these levels (i.e., channels that are
+        off but will be actuated because they share a gate with one active
+        channel and a source with another).
+    '''
+    state = as_channel_state(state)
+    gates = sources = 0
+    for channel in state:
+        gates |= _CHANNEL_GATE_BIT[channel]
+        sources |= _CHANNEL_SOURCE_BIT[channel]
+
+    # active gates are driven high and active sources (S1-S8) low
+    pin_bits = gates | (~sources >> 1 & _SOURCE_PIN_MASK) << N_GATES
+    levels = (pin_bits >> _PIN_SHIFTS & 1).astype(np.uint8)
+
+    actuated = _union(GATE_CHANNELS, gates) & _union(SOURCE_CHANNELS, sources)
+    return levels, ChannelState(actuated & ~state.bits)
+
+
+def _group_frames(matrix):
+    '''
+    Partition the active cells of a (gate x source) matrix into frames by
+    grouping rows with identical patterns. Each frame is the cartesian
+    product of a group of rows and their shared pattern, so it can be driven
+    without actuating any other cell.
+    '''
+    groups = {}
+    for row in np.flatnonzero(matrix.any(axis=1)):
+        groups.setdefault(tuple(matrix[row]), []).append(row)
+    frames = []
+    for rows in groups.values():
+        selected = np.zeros(matrix.shape, dtype=bool)
+        selected[rows] = matrix[rows[0]]
+        frames.append(selected)
+    return frames
+
+
+def multiplex_frames(state):
+    '''
+    Split a channel state into frames that the gate/source matrix can drive
+    simultaneously.
+
+    Parameters:
+        state : ChannelState or sequence of up to N_CHANNELS channel states
+
+    Returns:
+        (frames, duty_cycle) tuple, where frames is a list of ChannelStates
+        (each representable by a single pin level vector, and which
+        together actuate every requested channel exactly once) and duty_cycle
+        is an array of length N_CHANNELS containing the fraction of time each
+        channel is actuated if the frames are cycled with equal periods.
+
+    Frames are built by grouping gates that drive the same set of sources
+    (or sources driven by the same set of gates), whichever gives fewer
+    frames. A state that the matrix can represent directly yields a single
+    frame.
+    '''
+    state = as_channel_state(state)
+    if not state_to_pin_levels(state)[1]:
+        frames = [state]
+    else:
+        channels = list(state)
+        matrix = np.zeros((N_GATES, N_SOURCES + 1), dtype=bool)
+        matrix[CHANNEL_GATE[channels], CHANNEL_SOURCE[channels]] = True
+        by_gate = _group_frames(matrix)
+        by_source = [frame.T for frame in _group_frames(matrix.T)]
+        frames = [ChannelState.from_array(frame[CHANNEL_GATE, CHANNEL_SOURCE])
+                  for frame in min(by_gate, by_source, key=len)]
+
+    duty_cycle = (np.sum([frame.to_array(N_CHANNELS) for frame in frames],
+                         axis=0) / float(len(frames)))
+    return frames, duty_cycle
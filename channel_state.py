@@ -0,0 +1,115 @@
+"""
+Compact representation of the state of a set of channels.
+"""
+import numpy as np
+
+
+class ChannelState(object):
+    '''
+    Immutable set of active channels, stored as the bits of an integer (bit i
+    is set if channel i is active).
+
+    Channel states support the set operators (|, &, ^ and -), iterate over the
+    active channels in ascending order and are only converted to/from arrays
+    at the boundary with MicroDrop (see from_array() and to_array()).
+    '''
+    __slots__ = ('bits', )
+
+    def __init__(self, bits=0):
+        if bits < 0:
+            raise ValueError('Channel state bits must be non-negative.')
+        self.bits = bits
+
+    @classmethod
+    def from_array(cls, state_array):
+        '''
+        Create a channel state from a sequence of channel states (channels
+        with a non-zero state are active).
+        '''
+        return cls.from_channels(np.flatnonzero(np.asarray(state_array)
+                                                .ravel()))
+
+    @classmethod
+    def from_channels(cls, channels):
+        '''
+        Create a channel state from a sequence of active channels.
+        '''
+        bits = 0
+        for channel in channels:
+            bits |= 1 << int(channel)
+        return cls(bits)
+
+    def to_array(self, n_channels):
+        '''
+        Return a boolean array of length n_channels that is True for each
+        active channel.
+        '''
+        state = np.zeros(n_channels, dtype=bool)
+        channels = list(self)
+        if channels and channels[-1] >= n_channels:
+            raise ValueError('Channel %d is out of range (%d channels).' %
+                             (channels[-1], n_channels))
+        state[channels] = True
+        return state
+
+    def count(self):
+        '''
+        Return the number of active channels.
+        '''
+        return bin(self.bits).count('1')
+
+    def diff(self, other):
+        '''
+        Return the channels whose state differs from `other`.
+        '''
+        return ChannelState(self.bits ^ other.bits)
+
+    def slice(self, start, length):
+        '''
+        Return the state of channels start to start + length - 1, renumbered
+        from zero.
+        '''
+        return ChannelState(self.bits >> start & ((1 << length) - 1))
+
+    def max_channel(self):
+        '''
+        Return the highest active channel (-1 if no channel is active).
+        '''
+        return self.bits.bit_length() - 1
+
+    def __iter__(self):
+        bits = self.bits
+        while bits:
+            lowest = bits & -bits
+            yield lowest.bit_length() - 1
+            bits ^= lowest
+
+    def __contains__(self, channel):
+        return channel >= 0 and bool(self.bits >> channel & 1)
+
+    def __nonzero__(self):
+        return self.bits != 0
+
+    def __or__(self, other):
+        return ChannelState(self.bits | other.bits)
+
+    def __and__(self, other):
+        return ChannelState(self.bits & other.bits)
+
+    def __xor__(self, other):
+        return ChannelState(self.bits ^ other.bits)
+
+    def __sub__(self, other):
+        return ChannelState(self.bits & ~other.bits)
+
+    def __eq__(self, other):
+        return isinstance(other, ChannelState) and self.bits == other.bits
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.bits)
+
+    def __repr__(self):
+        return 'ChannelState(%s)' % list(self)
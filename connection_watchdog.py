@@ -0,0 +1,183 @@
+"""
+Background monitoring of the connection to OpenDrop boards, with automatic
+reconnection.
+"""
+import logging
+import threading
+from collections import deque
+
+from opendrop_board import READY_TIMEOUT
+from step_timer import monotonic
+
+
+# time (in seconds) between liveness pings
+PING_INTERVAL = 1.0
+# a ping that has not completed after this time (in seconds) counts as a stall
+STALL_TIMEOUT = 2.0
+# delay (in seconds) before the first reconnection attempt, doubled after
+# each failed attempt up to MAX_BACKOFF
+INITIAL_BACKOFF = 0.5
+MAX_BACKOFF = 30.0
+
+
+class Outage(object):
+    '''
+    Period during which a board was not responding (start and end are
+    monotonic times in seconds).
+    '''
+    def __init__(self, port, start):
+        self.port = port
+        self.start = start
+        self.end = None
+
+    @property
+    def duration(self):
+        return (monotonic() if self.end is None else self.end) - self.start
+
+    def __repr__(self):
+        return 'Outage(port=%s, duration=%.3f)' % (self.port, self.duration)
+
+
+class ConnectionWatchdog(threading.Thread):
+    '''
+    Thread that pings each board through its BoardWorker and reconnects
+    the boards that stop responding.
+
+    A board is down if a ping fails or has not completed within
+    `stall_timeout`. Reconnection is retried with exponential backoff; once
+    the board is back, its worker re-applies the last channel state and
+    `on_restored(board, outage)` is called through `dispatch` (e.g.,
+    `gobject.idle_add` to run it in the main loop).
+
+    Boards that have not been connected or that were disconnected on purpose
+    (see OpenDropBoard.auto_reconnect) are ignored, and nothing is checked
+    while the watchdog is paused (e.g., while the plugin is connecting or
+    flashing firmware, which can take longer than the stall timeout). Pauses
+    nest: the watchdog resumes once resume() has been called for every
+    pause().
+    '''
+    def __init__(self, get_boards, dispatch=None, on_restored=None,
+                 ping_interval=PING_INTERVAL, stall_timeout=STALL_TIMEOUT,
+                 initial_backoff=INITIAL_BACKOFF, max_backoff=MAX_BACKOFF):
+        '''
+        Parameters:
+            get_boards : function returning a list of the (board, worker)
+                pairs to monitor
+        '''
+        super(ConnectionWatchdog, self).__init__(name='OpenDropWatchdog')
+        self.daemon = True
+        self.get_boards = get_boards
+        if dispatch is None:
+            dispatch = lambda callback, *args: callback(*args)
+        self.dispatch = dispatch
+        self.on_restored = on_restored
+        self.ping_interval = ping_interval
+        self.stall_timeout = stall_timeout
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.outages = deque(maxlen=1000)
+        self._paused = threading.Event()
+        self._pause_count = 0
+        self._pause_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._wakeup = threading.Event()
+
+    def pause(self):
+        with self._pause_lock:
+            self._pause_count += 1
+            self._paused.set()
+
+    def resume(self):
+        with self._pause_lock:
+            self._pause_count = max(self._pause_count - 1, 0)
+            if not self._pause_count:
+                self._paused.clear()
+
+    def check_now(self):
+        '''
+        Ping the boards without waiting for the next ping interval (e.g.,
+        after a command failed).
+        '''
+        self._wakeup.set()
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+        self.join()
+
+    def outage_summary(self):
+        '''
+        Return a dictionary with the number of outages and their total and
+        maximum duration (in seconds).
+        '''
+        durations = [outage.duration for outage in list(self.outages)]
+        return {'count': len(durations),
+                'total': sum(durations),
+                'max': max(durations) if durations else 0.}
+
+    def _active(self):
+        return not (self._stopped.is_set() or self._paused.is_set())
+
+    def run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.ping_interval)
+            self._wakeup.clear()
+            if not self._active():
+                continue
+            for board, worker in self._unresponsive_boards():
+                self._recover(board, worker)
+
+    def _unresponsive_boards(self):
+        boards = [(board, worker) for board, worker in self.get_boards()
+                  if board.auto_reconnect]
+        # ping every board before waiting for any of them
+        pings = [(board, worker, worker.submit('ping'))
+                 for board, worker in boards]
+        unresponsive = []
+        for board, worker, result in pings:
+            completed = result.wait(self.stall_timeout)
+            if not self._active():
+                # the ping may have been stuck behind a connect or flash
+                return []
+            if not completed:
+                logging.warning('[ConnectionWatchdog] board on %s stalled '
+                                '(no response within %.1f s)' %
+                                (board.serial_device.port,
+                                 self.stall_timeout))
+                unresponsive.append((board, worker))
+            elif result.error is not None or not board.connected():
+                logging.warning('[ConnectionWatchdog] board on %s is not '
+                                'responding: %s' % (board.serial_device.port,
+                                                    result.error or
+                                                    'disconnected'))
+                unresponsive.append((board, worker))
+        return unresponsive
+
+    def _recover(self, board, worker):
+        '''
+        Reconnect a board (retrying with exponential backoff) and restore its
+        channel state.
+        '''
+        outage = Outage(board.serial_device.port, monotonic())
+        backoff = self.initial_backoff
+        result = None
+        while self._active() and board.auto_reconnect:
+            # don't queue another attempt behind one that is still running
+            if result is None or result.wait(0):
+                result = worker.submit('reconnect')
+            if (result.wait(READY_TIMEOUT + self.stall_timeout) and
+                    result.error is None and board.connected()):
+                break
+            logging.info('[ConnectionWatchdog] could not reconnect to %s; '
+                         'retrying in %.1f s' % (outage.port, backoff))
+            self._stopped.wait(backoff)
+            backoff = min(2 * backoff, self.max_backoff)
+        else:
+            return
+        outage.end = monotonic()
+        self.outages.append(outage)
+        logging.warning('[ConnectionWatchdog] reconnected to %s after %.1f s'
+                        % (outage.port, outage.duration))
+        worker.restore_state()
+        if self.on_restored is not None:
+            self.dispatch(self.on_restored, board, outage)
@@ -0,0 +1,154 @@
+"""
+Diagnostics for the OpenDrop actuation path.
+"""
+import csv
+import time
+import threading
+from collections import deque
+
+import numpy as np
+
+
+class ActuationTrace(object):
+    '''
+    Ring buffer of the pin level vectors written to a board.
+
+    Each record holds the wall-clock time of the write, the protocol step
+    being actuated (None outside of a protocol) and the pin level vector,
+    packed into an integer (bit i is the level of pin vector entry i).
+    Recording is a no-op unless the trace is enabled.
+    '''
+    def __init__(self, maxlen=10000, enabled=False):
+        self.enabled = enabled
+        self.step_number = None
+        self._records = deque(maxlen=maxlen)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._records)
+
+    def record(self, pin_levels):
+        if not self.enabled:
+            return
+        packed = 0
+        for i in np.flatnonzero(pin_levels):
+            packed |= 1 << int(i)
+        with self._lock:
+            self._records.append((time.time(), self.step_number, packed))
+
+    def records(self):
+        '''
+        Return a list of (timestamp, step_number, packed_pin_levels) tuples,
+        oldest first.
+        '''
+        with self._lock:
+            return list(self._records)
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+
+    def dump(self, output, pins):
+        '''
+        Write the trace as CSV to a path or file-like object.
+
+        Parameters:
+            output : path or file-like object
+            pins : list of the digital pins corresponding to each entry of
+                the pin level vector (one column is written per pin)
+
+        Returns:
+            number of records written
+        '''
+        records = self.records()
+        if isinstance(output, basestring):
+            with open(output, 'wb') as f:
+                return self._write(f, records, pins)
+        return self._write(output, records, pins)
+
+    def _write(self, f, records, pins):
+        writer = csv.writer(f)
+        writer.writerow(['timestamp', 'step'] + ['D%d' % pin for pin in pins])
+        for timestamp, step_number, packed in records:
+            writer.writerow(['%.6f' % timestamp,
+                             '' if step_number is None else step_number] +
+                            [(packed >> i) & 1 for i in range(len(pins))])
+        return len(records)
+
+
+class LatencyStats(object):
+    '''
+    Call counts and latency distributions, grouped by call type.
+
+    The most recent `maxlen` latencies of each call type are kept to
+    compute percentiles; counts and totals cover every call.
+    '''
+    def __init__(self, maxlen=1000):
+        self.maxlen = maxlen
+        self._samples = {}
+        self._counts = {}
+        self._totals = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def combine(cls, stats):
+        '''
+        Return a LatencyStats holding the calls recorded by each of a list of
+        LatencyStats (e.g., one per board).
+        '''
+        combined = cls(maxlen=sum(other.maxlen for other in stats) or 1000)
+        for other in stats:
+            with other._lock:
+                for name, samples in other._samples.items():
+                    if name not in combined._samples:
+                        combined._samples[name] = deque(
+                            maxlen=combined.maxlen)
+                        combined._counts[name] = 0
+                        combined._totals[name] = 0.
+                    combined._samples[name].extend(samples)
+                    combined._counts[name] += other._counts[name]
+                    combined._totals[name] += other._totals[name]
+        return combined
+
+    def record(self, name, latency):
+        '''
+        Record the latency (in seconds) of a call of the specified type.
+        '''
+        with self._lock:
+            if name not in self._samples:
+                self._samples[name] = deque(maxlen=self.maxlen)
+                self._counts[name] = 0
+                self._totals[name] = 0.
+            self._samples[name].append(latency)
+            self._counts[name] += 1
+            self._totals[name] += latency
+
+    def samples(self, name):
+        '''
+        Return an array of the recent latencies (in seconds) of the specified
+        call type.
+        '''
+        with self._lock:
+            return np.array(self._samples.get(name, []), dtype=float)
+
+    def clear(self):
+        with self._lock:
+            self._samples.clear()
+            self._counts.clear()
+            self._totals.clear()
+
+    def summary(self):
+        '''
+        Return a dictionary mapping each call type to a dictionary with its
+        count and its mean, p50, p95 and p99 latency (in ms).
+        '''
+        with self._lock:
+            items = [(name, np.array(samples, dtype=float), self._counts[name],
+                      self._totals[name])
+                     for name, samples in self._samples.items()]
+        summary = {}
+        for name, samples, count, total in items:
+            p50, p95, p99 = np.percentile(samples, [50, 95, 99]) * 1e3
+            summary[name] = {'count': count, 'mean': total / count * 1e3,
+                             'p50': p50, 'p95': p95, 'p99': p99}
+        return summary
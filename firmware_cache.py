@@ -0,0 +1,160 @@
+"""
+Local cache of OpenDrop firmware images.
+
+Images are stored under the cache directory as <board type>/<version>/<file>
+and listed in a JSON manifest with the SHA-256 hash of each file, so that an
+image is only copied from the installed open_drop package once per version
+and a corrupted or modified copy is detected (and replaced) before it is
+flashed.
+"""
+import os
+import json
+import shutil
+import hashlib
+import logging
+import threading
+
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.opendrop',
+                                 'firmware')
+MANIFEST_NAME = 'manifest.json'
+# name reported by boards running the OpenDrop firmware
+FIRMWARE_NAME = 'open_drop'
+# board type (as passed to arduino_helpers.upload) for each major hardware
+# version
+BOARD_TYPES = {1: 'uno'}
+
+# serializes access to the manifests (boards may be flashed concurrently)
+_lock = threading.Lock()
+
+
+def board_type(hardware_version):
+    '''
+    Return the board type for a hardware version (e.g., "1.0.0" or a
+    microdrop_utility.Version).
+    '''
+    try:
+        return BOARD_TYPES[int(str(hardware_version).split('.')[0])]
+    except (KeyError, ValueError):
+        raise ValueError('No firmware for hardware version %s.' %
+                         hardware_version)
+
+
+def file_hash(path):
+    '''
+    Return the SHA-256 hash (hex digest) of a file.
+    '''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def firmware_matches(properties, image):
+    '''
+    Return True if a board with the specified properties is already running
+    the firmware image (i.e., it reports the OpenDrop firmware name and the
+    image's version).
+    '''
+    return (properties.get('name') == FIRMWARE_NAME and
+            str(properties.get('software_version')) == image.version)
+
+
+class FirmwareImage(object):
+    def __init__(self, board_type, version, path, sha256):
+        self.board_type = board_type
+        self.version = version
+        self.path = path
+        self.sha256 = sha256
+
+    def __repr__(self):
+        return ('FirmwareImage(board_type=%s, version=%s, sha256=%s)' %
+                (self.board_type, self.version, self.sha256[:12]))
+
+
+class FirmwareCache(object):
+    '''
+    Firmware images keyed by board type and version.
+    '''
+    def __init__(self, root=DEFAULT_CACHE_DIR):
+        self.root = root
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.root, MANIFEST_NAME)
+
+    def _read_manifest(self):
+        try:
+            with open(self.manifest_path) as f:
+                return json.load(f)
+        except IOError:
+            return {}
+        except ValueError, why:
+            logging.warning('[FirmwareCache] ignoring corrupted manifest %s: '
+                            '%s' % (self.manifest_path, why))
+            return {}
+
+    def _write_manifest(self, manifest):
+        temp_path = self.manifest_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        # os.rename() does not replace existing files on Windows
+        if os.path.exists(self.manifest_path):
+            os.remove(self.manifest_path)
+        os.rename(temp_path, self.manifest_path)
+
+    def get(self, board_type, version):
+        '''
+        Return the cached image for a board type and version (or None if it
+        is not cached or its content no longer matches its hash).
+        '''
+        with _lock:
+            entry = self._read_manifest().get('%s/%s' % (board_type,
+                                                         version))
+        if entry is None:
+            return None
+        path = os.path.join(self.root, entry['path'])
+        if not os.path.exists(path) or file_hash(path) != entry['sha256']:
+            logging.warning('[FirmwareCache] cached firmware %s is missing '
+                            'or corrupted' % path)
+            return None
+        return FirmwareImage(board_type, version, path, entry['sha256'])
+
+    def add(self, board_type, version, source_path):
+        '''
+        Copy a firmware file into the cache (replacing any cached image for
+        the same board type and version).
+
+        Returns:
+            FirmwareImage for the cached copy
+        '''
+        key = '%s/%s' % (board_type, version)
+        relative_path = os.path.join(board_type, version,
+                                     os.path.basename(source_path))
+        path = os.path.join(self.root, relative_path)
+        with _lock:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            shutil.copyfile(source_path, path)
+            sha256 = file_hash(path)
+            manifest = self._read_manifest()
+            manifest[key] = {'path': relative_path, 'sha256': sha256}
+            self._write_manifest(manifest)
+        logging.info('[FirmwareCache] cached %s firmware %s (%s)' %
+                     (board_type, version, sha256[:12]))
+        return FirmwareImage(board_type, version, path, sha256)
+
+    def image(self, board_type, version, find_source):
+        '''
+        Return the image for a board type and version, adding it to the cache
+        first if necessary.
+
+        Parameters:
+            find_source : function returning the path of the firmware file
+                for a board type (only called if the image is not cached)
+        '''
+        image = self.get(board_type, version)
+        if image is None:
+            image = self.add(board_type, version, find_source(board_type))
+        return image
@@ -1,17 +1,31 @@
 import time
 import logging
-import pkg_resources
 
-from open_drop import Proxy, get_firmwares
-from serial import Serial
-from serial_device import get_serial_ports
-import arduino_helpers.upload
+import numpy as np
+
+from step_timer import monotonic
+from port_discovery import find_board
+from diagnostics import ActuationTrace, LatencyStats
+from simulator import is_simulated_port, open_simulated_port
+from firmware_cache import FirmwareCache, board_type, firmware_matches
+from channel_map import (LOW, HIGH, N_CHANNELS, GATE_PIN_OFFSET,
+                         SOURCE_PIN_OFFSET, FIRST_PIN, N_PINS, CHANNEL_GATE,
+                         CHANNEL_SOURCE, CLEARED_PIN_LEVELS,
+                         as_channel_state, state_to_pin_levels)
 
 
 INPUT = 0
 OUTPUT = 1
-LOW = 0
-HIGH = 1
+
+# names of the firmware commands used to write several pins (or set several
+# pin modes) in one transaction
+BULK_DIGITAL_WRITE = 'digital_write_multiple'
+BULK_PIN_MODE = 'pin_mode_multiple'
+
+# maximum time (in seconds) to wait for the board to respond after opening
+# the serial port, and the interval between attempts
+READY_TIMEOUT = 5.0
+READY_POLL_INTERVAL = 0.1
 
 
 class OpenDropBoard(object):
@@ -21,6 +35,26 @@ class OpenDropBoard(object):
     '''
     def __init__(self):
         self.serial_device = None
+        # True while connected, until disconnect() is called (used to tell a
+        # dropped connection from one that was closed on purpose)
+        self.auto_reconnect = False
+
+        # cache of the last level written to each pin (None if unknown)
+        self._pin_levels = None
+        self._bulk_digital_write = False
+        # device properties (fetched once per connection)
+        self._properties = None
+        # optional record of every pin level vector written to the board
+        self.trace = ActuationTrace()
+        # latency of each call type (RPCs, connect and firmware flashing) and
+        # number of bytes sent/received over the serial port
+        self.rpc_stats = LatencyStats()
+        self.bytes_written = 0
+        self.bytes_read = 0
+        # time (in seconds) taken by the last connection to become ready, and
+        # to complete (including pin initialization)
+        self.ready_time = None
+        self.connect_time = None
 
         # the following must be defined as properties or members
         # todo: query these from the device
@@ -52,56 +86,312 @@ class OpenDropBoard(object):
         # todo
         pass
     
+    @classmethod
+    def probe(cls, serial_port, baud_rate=115200, timeout=READY_TIMEOUT):
+        '''
+        Open the specified port and wait for a board to respond, without
+        configuring any pins.
+
+        Returns:
+            the open board (raises RuntimeError if no board responded)
+        '''
+        board = cls()
+        try:
+            board._open(serial_port, baud_rate, timeout)
+        except:
+            board.disconnect()
+            raise
+        return board
+
     def connect(self, serial_port=None, baud_rate=115200):
+        start = monotonic()
         if serial_port is None or serial_port == 'None':
             # check if we're reconnecting (i.e., already have a port number)
             serial_port = self.port
 
-            # if not, try connecting to the first available port
+            # if not, search the available ports for an OpenDrop
             if serial_port is None:
-                serial_port = [port for port in get_serial_ports()][0]
-        
-        # if there's no port to try, return
-        if serial_port is None:
-            return
+                serial_port, board = find_board(self.probe, baud_rate)
+
+                # if there's no board to connect to, return
+                if serial_port is None:
+                    return
+                self._adopt(board)
+                self.ready_time = monotonic() - start
+                self._initialize_pins(start)
+                return
 
         if not (self.port == serial_port and self.baud_rate == baud_rate):
-            self.serial_device = Serial(serial_port, baudrate=baud_rate)
+            self._open(serial_port, baud_rate)
+            self.ready_time = monotonic() - start
+            self._initialize_pins(start)
+
+    def _open(self, serial_port, baud_rate, timeout=READY_TIMEOUT):
+        if is_simulated_port(serial_port):
+            self.serial_device, self.proxy = open_simulated_port(serial_port,
+                                                                 baud_rate)
+        else:
+            # the hardware packages are only needed once we connect to a board
+            from open_drop import Proxy
+            from serial import Serial
+
+            self.serial_device = Serial(serial_port, baudrate=baud_rate,
+                                        timeout=READY_POLL_INTERVAL)
             self.proxy = Proxy(self.serial_device)
-            
-            # wait for board to initialize
-            time.sleep(2)
-    
-            # initialize the digital pins 2-18 as an outputs
-            for pin in range(2, 19):
-                self.proxy.pin_mode(pin, OUTPUT)
-            self.clear_all_channels()
+        self._pin_levels = None
+        self._properties = None
+        self._bulk_digital_write = hasattr(self.proxy, BULK_DIGITAL_WRITE)
+        self._count_bytes(self.serial_device)
+
+        # wait for board to initialize
+        self._wait_until_ready(timeout)
+
+    def _adopt(self, board):
+        '''
+        Take over the connection of another (open) board instance.
+        '''
+        self.serial_device = board.serial_device
+        self.proxy = board.proxy
+        self._count_bytes(self.serial_device)
+        self._pin_levels = None
+        self._properties = board._properties
+        self._bulk_digital_write = board._bulk_digital_write
+
+    def _initialize_pins(self, start):
+        '''
+        Initialize the digital pins 2-18 as outputs with all channels off
+        (setting the levels first so that the pins never glitch) and record
+        the connection time since `start`.
+        '''
+        self.clear_all_channels()
+        pins = range(FIRST_PIN, FIRST_PIN + N_PINS)
+        if hasattr(self.proxy, BULK_PIN_MODE):
+            self._rpc(BULK_PIN_MODE, pins, [OUTPUT] * N_PINS)
+        else:
+            for pin in pins:
+                self._rpc('pin_mode', pin, OUTPUT)
+        self.connect_time = monotonic() - start
+        self.rpc_stats.record('connect', self.connect_time)
+        self.auto_reconnect = True
+        logging.info('[OpenDropBoard] connected to %s in %.2f s (ready after '
+                     '%.2f s)' % (self.port, self.connect_time,
+                                  self.ready_time))
+
+    def _wait_until_ready(self, timeout=READY_TIMEOUT):
+        '''
+        Poll the board until it responds (e.g., once its bootloader has
+        finished after the serial port was opened), caching its properties.
+        '''
+        start = monotonic()
+        while True:
+            try:
+                self._properties = self._rpc('properties')
+                return
+            except Exception, why:
+                if monotonic() - start > timeout:
+                    raise RuntimeError('Board on port %s did not respond '
+                                       'within %.1f s (%s).' %
+                                       (self.serial_device.port, timeout,
+                                        why))
+                time.sleep(READY_POLL_INTERVAL)
 
     def disconnect(self):
+        self.auto_reconnect = False
+        self._pin_levels = None
+        self._properties = None
         try:
             self.proxy._packet_watcher.terminate()
+        except:
+            pass
+        try:
             self.serial_device.close()
         except:
             pass
 
+    def reconnect(self):
+        '''
+        Close the connection (if it is still open) and connect again to the
+        same port.
+        '''
+        if self.serial_device is None:
+            raise RuntimeError('The board has never been connected.')
+        serial_port = self.serial_device.port
+        baud_rate = self.serial_device.baudrate
+        self.disconnect()
+        # keep trying if this attempt fails
+        self.auto_reconnect = True
+        self.connect(serial_port, baud_rate)
+
+    def ping(self):
+        '''
+        Check that the board responds (bypassing the cached properties).
+
+        Returns:
+            round-trip time in seconds
+        '''
+        start = monotonic()
+        self._rpc('properties')
+        return monotonic() - start
+
     def connected(self):
         if self.serial_device and self.serial_device.isOpen():
             return True
         else:
             return False
 
-    def flash_firmware(self, hardware_version):
-        logging.info(arduino_helpers.upload.upload('uno',
-                     lambda b: get_firmwares()[b][0], self.port))
+    def flash_firmware(self, hardware_version, force=False, progress=None,
+                       cache=None):
+        '''
+        Flash the firmware matching the host driver version, unless the board
+        is already running it, and reconnect to the board.
+
+        Parameters:
+            hardware_version : hardware version of the board (selects the
+                board type of the firmware image)
+            force : flash even if the board already runs the firmware
+            progress : optional function called with (message, fraction)
+                as flashing progresses
+            cache : FirmwareCache to take the image from (defaults to the
+                cache in the user's home directory)
+
+        Returns:
+            True if the board was flashed, False if it was skipped
+        '''
+        if progress is None:
+            progress = lambda message, fraction: None
+        if cache is None:
+            cache = FirmwareCache()
+        start = monotonic()
+        progress('finding firmware', 0.)
+        version = self.host_software_version()
+        image = cache.image(board_type(hardware_version), version,
+                            self._packaged_firmware)
+
+        if not force and self.connected():
+            progress('checking firmware on the board', 0.1)
+            if firmware_matches(self.properties(), image):
+                logging.info('[OpenDropBoard] %s already runs firmware %s; '
+                             'skipping flash' % (self.port, version))
+                progress('firmware is up to date', 1.)
+                return False
+
+        if self.serial_device is not None:
+            serial_port = self.serial_device.port
+            baud_rate = self.serial_device.baudrate
+        else:
+            serial_port, baud_rate = None, 115200
+        self.disconnect()
+        progress('uploading firmware %s' % version, 0.2)
+        self._upload(image, serial_port)
+        progress('reconnecting', 0.8)
+        self.connect(serial_port, baud_rate)
+        if not self.connected():
+            raise RuntimeError('Could not reconnect after flashing.')
+        progress('verifying firmware', 0.9)
+        if not firmware_matches(self.properties(), image):
+            raise RuntimeError('Board reports firmware %s %s after flashing '
+                               '%s.' % (self.name(), self.software_version(),
+                                        version))
+        self.rpc_stats.record('flash_firmware', monotonic() - start)
+        progress('firmware updated', 1.)
+        return True
+
+    def _packaged_firmware(self, board_type):
+        from open_drop import get_firmwares
+
+        return get_firmwares()[board_type][0]
+
+    def _upload(self, image, serial_port):
+        if is_simulated_port(serial_port):
+            # nothing to upload to
+            return
+        import arduino_helpers.upload
+
+        logging.info(arduino_helpers.upload.upload(image.board_type,
+                                                   lambda b: image.path,
+                                                   serial_port))
 
     # these are currently mutators (but could be converted to properties)
-    def set_state_of_all_channels(self, state_array):
-        self.clear_all_channels()
-        for channel, state in enumerate(state_array):
-            if state:
-                logging.info('[OpenDropBoard] set channel %d to %s' %
-                              (channel, ['HIGH', 'LOW'][state < 1]))
-                self.set_channel_state(channel, state)
+    def set_state_of_all_channels(self, state):
+        '''
+        Set the state of every channel, only writing the pins whose level
+        differs from the last level written to the board.
+
+        Parameters:
+            state : ChannelState or sequence of channel states
+        '''
+        state = as_channel_state(state)
+        levels, unrepresentable = state_to_pin_levels(state)
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug('[OpenDropBoard] set channels %s to HIGH',
+                          list(state))
+        if unrepresentable:
+            logging.warning('[OpenDropBoard] channels %s cannot be set '
+                            'independently; they will also be actuated.' %
+                            list(unrepresentable))
+        self.apply_pin_levels(levels)
+
+    def force_full_refresh(self):
+        '''
+        Rewrite every pin, regardless of the cached pin levels (e.g., if the
+        board may have been reset behind our back).
+        '''
+        if self._pin_levels is None or None in self._pin_levels:
+            self.clear_all_channels()
+        else:
+            self.apply_pin_levels(self._pin_levels, force=True)
+
+    def apply_pin_levels(self, levels, force=False):
+        '''
+        Write a vector of pin levels to the board.
+
+        Parameters:
+            levels : sequence of N_PINS levels, where levels[i] is the level
+                of digital pin FIRST_PIN + i
+            force : if True, write every pin; otherwise, only write the pins
+                whose level differs from the last level written
+
+        Returns:
+            the number of transactions sent to the board
+
+        If the firmware provides a bulk digital write command, all pins are
+        written in a single transaction; otherwise, each pin is written with
+        its own digital_write call.
+
+        Pins that switch channels off (gates going low and sources going
+        high) are written before pins that switch channels on, so that while
+        going from one state to another, only channels that are active in
+        both are ever actuated.
+        '''
+        if len(levels) != N_PINS:
+            raise ValueError('Expected %d pin levels (got %d).' %
+                             (N_PINS, len(levels)))
+        levels = np.asarray(levels, dtype=int)
+        if force or self._pin_levels is None or None in self._pin_levels:
+            changed = np.arange(N_PINS)
+        else:
+            changed = np.flatnonzero(levels != self._pin_levels)
+        # switching-off pins first (stable, so pins stay in index order
+        # within each group)
+        changed = changed[np.argsort(levels[changed] !=
+                                     CLEARED_PIN_LEVELS[changed],
+                                     kind='mergesort')]
+        pins = [int(i) + FIRST_PIN for i in changed]
+        pin_levels = [int(level) for level in levels[changed]]
+        if not pins:
+            return 0
+        self.trace.record(levels)
+
+        if self._pin_levels is None:
+            self._pin_levels = [None] * N_PINS
+        if self._bulk_digital_write:
+            self._rpc(BULK_DIGITAL_WRITE, pins, pin_levels)
+            for pin, level in zip(pins, pin_levels):
+                self._pin_levels[pin - FIRST_PIN] = level
+            return 1
+        for pin, level in zip(pins, pin_levels):
+            self._digital_write(pin, level)
+        return len(pins)
 
     def set_waveform_voltage(self, voltage):
         pass
@@ -112,16 +402,27 @@ class OpenDropBoard(object):
     # these are currently accessors (but could be converted to properties)
     def number_of_channels(self):
         # todo: query this from the device
-        return 68
+        return N_CHANNELS
     
+    def properties(self):
+        '''
+        Return the device properties, querying the device only the first time
+        they are requested after connecting.
+        '''
+        if self._properties is None:
+            self._properties = self._rpc('properties')
+        return self._properties
+
     def name(self):
-        return self.proxy.properties()['name']
+        return self.properties()['name']
     
     def host_software_version(self):
+        import pkg_resources
+
         return pkg_resources.get_distribution('open_drop').version
     
     def software_version(self):
-        return self.proxy.properties().software_version
+        return self.properties()['software_version']
 
     def hardware_version(self):
         # todo: query this from the device
@@ -131,35 +432,64 @@ class OpenDropBoard(object):
     # API.
     # todo: move implementation to firmware 
     def set_gate(self, i, state):
-        logging.info('[OpenDropBoard] set G%d %s'
-                      % (i, ['HIGH', 'LOW'][state < 1]))
-        logging.info('proxy.digital_write(%d, %s)'
-                      % (2 + i, ['HIGH', 'LOW'][state < 1]))
-        self.proxy.digital_write(2 + i, state)
+        logging.debug('[OpenDropBoard] set G%d (pin %d) %s', i,
+                      GATE_PIN_OFFSET + i, ['HIGH', 'LOW'][state < 1])
+        self._digital_write(GATE_PIN_OFFSET + i, state)
 
     def set_source(self, i, state):
-        logging.info('[OpenDropBoard] set S%d %s'
-                      % (i, ['HIGH', 'LOW'][state < 1]))
-        logging.info('proxy.digital_write(%d, %s)'
-                      % (10 + i, ['HIGH', 'LOW'][state < 1]))
-        self.proxy.digital_write(10 + i, state)
+        logging.debug('[OpenDropBoard] set S%d (pin %d) %s', i,
+                      SOURCE_PIN_OFFSET + i, ['HIGH', 'LOW'][state < 1])
+        self._digital_write(SOURCE_PIN_OFFSET + i, state)
 
     def clear_all_channels(self):
-        # set all gate pins low
-        for i in range(0, 9):
-            self.set_gate(i, LOW)
-
-        # set all source pins high
-        for i in range(1, 9):
-            self.set_source(i, HIGH)
+        # set all gate pins low and all source pins high
+        self.apply_pin_levels(CLEARED_PIN_LEVELS, force=True)
 
     def set_channel_state(self, channel, state):
-        if channel < 2:
-            self.set_source(2 * channel + 1, int(not bool(state)))
-            self.set_gate(0, state)
-        elif channel < 4:
-            self.set_source(2 * channel + 2, int(not bool(state)))
-            self.set_gate(0, state)
-        else:
-            self.set_source((channel - 4) % 8 + 1, int(not bool(state)))
-            self.set_gate((channel - 4) / 8 + 1, state)
+        gate, source = self._channel_gate_and_source(channel)
+        self.set_source(source, int(not bool(state)))
+        self.set_gate(gate, state)
+
+    def _channel_gate_and_source(self, channel):
+        '''
+        Return the (gate, source) indices that address the specified channel.
+        '''
+        return int(CHANNEL_GATE[channel]), int(CHANNEL_SOURCE[channel])
+
+    def _rpc(self, name, *args):
+        '''
+        Call the specified proxy method, recording its latency.
+        '''
+        start = monotonic()
+        try:
+            return getattr(self.proxy, name)(*args)
+        finally:
+            self.rpc_stats.record(name, monotonic() - start)
+
+    def _count_bytes(self, serial_device):
+        '''
+        Wrap the read and write methods of the serial device to count the
+        number of bytes transferred (replacing the wrappers of any other
+        board that was counting them).
+        '''
+        read, write = getattr(serial_device, '_uncounted_io',
+                              (serial_device.read, serial_device.write))
+        serial_device._uncounted_io = read, write
+
+        def counting_read(*args, **kwargs):
+            data = read(*args, **kwargs)
+            self.bytes_read += len(data)
+            return data
+
+        def counting_write(data):
+            self.bytes_written += len(data)
+            return write(data)
+
+        serial_device.read = counting_read
+        serial_device.write = counting_write
+
+    def _digital_write(self, pin, level):
+        self._rpc('digital_write', pin, level)
+        if self._pin_levels is None:
+            self._pin_levels = [None] * N_PINS
+        self._pin_levels[pin - FIRST_PIN] = level
@@ -0,0 +1,184 @@
+"""
+Discovery of OpenDrop boards on the available serial ports.
+
+Candidate ports are probed concurrently, and the identity of each board found
+is cached (keyed by USB serial number where available, and otherwise by port)
+so that later searches can try the known port first.
+"""
+import os
+import re
+import json
+import time
+import Queue
+import logging
+import threading
+
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.opendrop_plugin',
+                                  'ports.json')
+
+# name reported by OpenDrop boards
+BOARD_NAME = 'open_drop'
+
+
+def get_usb_serial_numbers():
+    '''
+    Return a dictionary mapping serial ports to the serial number of the USB
+    device behind them (for the ports where it is known).
+    '''
+    try:
+        from serial.tools.list_ports import comports
+    except ImportError:
+        return {}
+    serial_numbers = {}
+    for info in comports():
+        match = re.search(r'SER=(\S+)', info[2] or '')
+        if match:
+            serial_numbers[info[0]] = match.group(1)
+    return serial_numbers
+
+
+def _cache_key(port, serial_numbers):
+    if port in serial_numbers:
+        return 'SER:' + serial_numbers[port]
+    return 'PORT:' + port
+
+
+def load_cache(cache_path=DEFAULT_CACHE_PATH):
+    try:
+        with open(cache_path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_cache(cache, cache_path=DEFAULT_CACHE_PATH):
+    try:
+        if not os.path.isdir(os.path.dirname(cache_path)):
+            os.makedirs(os.path.dirname(cache_path))
+        with open(cache_path, 'w') as f:
+            json.dump(cache, f, indent=2)
+    except (IOError, OSError), why:
+        logging.warning('[port_discovery] could not save port cache: %s' %
+                        why)
+
+
+def probe_ports(ports, probe, baud_rate, timeout, accept=None):
+    '''
+    Probe several ports concurrently.
+
+    Parameters:
+        ports : list of serial ports
+        probe : function called as probe(port, baud_rate, timeout) that
+            returns an open board on success or raises an exception
+        baud_rate : baud rate to open the ports with
+        timeout : maximum time (in seconds) to wait for each board to respond
+        accept : optional function called as accept(port, board) for each
+            board as it responds; once it returns True, the remaining probes
+            are not waited for (the boards they find are disconnected in the
+            background)
+
+    Returns:
+        dictionary mapping each port where probe succeeded to the open board
+    '''
+    results = Queue.Queue()
+
+    def _probe(port):
+        try:
+            board = probe(port, baud_rate, timeout)
+        except Exception, why:
+            logging.debug('[port_discovery] no board on %s: %s' % (port, why))
+            board = None
+        results.put((port, board))
+
+    for port in ports:
+        thread = threading.Thread(target=_probe, args=(port, ))
+        thread.daemon = True
+        thread.start()
+
+    boards = {}
+    pending = len(ports)
+    while pending:
+        port, board = results.get()
+        pending -= 1
+        if board is None:
+            continue
+        boards[port] = board
+        if accept is not None and accept(port, board):
+            break
+
+    def _disconnect_late_boards(pending):
+        for i in range(pending):
+            port, board = results.get()
+            if board is not None:
+                board.disconnect()
+
+    if pending:
+        thread = threading.Thread(target=_disconnect_late_boards,
+                                  args=(pending, ))
+        thread.daemon = True
+        thread.start()
+    return boards
+
+
+def find_board(probe, baud_rate=115200, timeout=2.5, ports=None,
+               cache_path=DEFAULT_CACHE_PATH):
+    '''
+    Find an OpenDrop board.
+
+    Ports where an OpenDrop board was found previously are tried first;
+    if none of them responds, all other ports are probed concurrently. The
+    search returns as soon as an OpenDrop board responds.
+
+    Parameters:
+        probe : function called as probe(port, baud_rate, timeout) that
+            returns an open board (with a name() method) or raises an
+            exception
+        baud_rate : baud rate to open the ports with
+        timeout : maximum time (in seconds) to wait for each board to respond
+        ports : list of ports to search (defaults to all serial ports)
+        cache_path : path of the port cache (None to disable caching)
+
+    Returns:
+        (port, board) tuple, where board is open, or (None, None) if no
+        OpenDrop board was found
+    '''
+    if ports is None:
+        from serial_device import get_serial_ports
+
+        ports = [port for port in get_serial_ports()]
+    serial_numbers = get_usb_serial_numbers()
+    cache = {} if cache_path is None else load_cache(cache_path)
+    known = [port for port in ports
+             if cache.get(_cache_key(port, serial_numbers), {})
+             .get('name') == BOARD_NAME]
+    others = [port for port in ports if port not in known]
+
+    names = {}
+
+    def _is_open_drop(port, board):
+        names[port] = board.name()
+        return names[port] == BOARD_NAME
+
+    for candidates in (known, others):
+        if not candidates:
+            continue
+        boards = probe_ports(candidates, probe, baud_rate, timeout,
+                             accept=_is_open_drop)
+        found = None
+        for port in candidates:
+            board = boards.get(port)
+            if board is None:
+                continue
+            name = names[port]
+            cache[_cache_key(port, serial_numbers)] = {
+                'port': port, 'name': name, 'last_seen': time.time()}
+            if name == BOARD_NAME and found is None:
+                found = port, board
+            else:
+                board.disconnect()
+        if cache_path is not None:
+            save_cache(cache, cache_path)
+        if found is not None:
+            return found
+    return None, None
@@ -0,0 +1,229 @@
+"""
+Estimate how long a compiled protocol will take to run on a given rig.
+
+The time a board needs to apply a step is predicted from the number of pin
+writes the step requires (see ActuationPlan.pin_deltas()) and a latency
+model fitted from the board's recent RPC timings (OpenDropBoard.rpc_stats).
+Steps end at absolute deadlines (see StepTimer), so a step only delays the
+protocol if its actuation takes longer than its duration.
+"""
+import math
+
+import numpy as np
+
+from channel_map import N_PINS
+from opendrop_board import BULK_DIGITAL_WRITE
+
+
+# latency (in seconds) assumed for each pin write transaction until the
+# board has recorded some
+DEFAULT_LATENCY = 0.005
+# probability of an overrun above which a step is reported as at risk
+RISK_THRESHOLD = 0.05
+
+
+def _normal_cdf(x):
+    return 0.5 * (1 + math.erf(x / math.sqrt(2)))
+
+
+class LatencyModel(object):
+    '''
+    Latency of the transactions used to write pin levels to a board.
+
+    Transaction latencies are modelled as independent, with the mean and
+    standard deviation of the recorded samples, so the cost of n
+    transactions has a mean of n * mean and a variance of n * std ** 2.
+    With the bulk digital write command, all the pins that change are
+    written in one transaction; otherwise each pin takes a transaction.
+    '''
+    def __init__(self, mean=DEFAULT_LATENCY, std=0., bulk=False,
+                 n_samples=0):
+        self.mean = mean
+        self.std = std
+        self.bulk = bulk
+        self.n_samples = n_samples
+
+    @classmethod
+    def fit(cls, board):
+        '''
+        Fit the model to the pin write latencies recorded by a board.
+        '''
+        bulk = board._bulk_digital_write
+        samples = board.rpc_stats.samples(BULK_DIGITAL_WRITE if bulk else
+                                          'digital_write')
+        if not len(samples):
+            return cls(bulk=bulk)
+        return cls(samples.mean(), samples.std(), bulk, len(samples))
+
+    def transactions(self, n_pins):
+        '''
+        Return the number of transactions needed to write n_pins pins (an
+        array or a scalar).
+        '''
+        n_pins = np.asarray(n_pins)
+        if self.bulk:
+            return (n_pins > 0).astype(int)
+        return n_pins
+
+    def cost(self, n_pins):
+        '''
+        Return the mean and variance of the time (in seconds) needed to write
+        n_pins pins.
+        '''
+        transactions = self.transactions(n_pins)
+        return transactions * self.mean, transactions * self.std ** 2
+
+    def __repr__(self):
+        return ('LatencyModel(mean=%.2f ms, std=%.2f ms, bulk=%s, '
+                'n_samples=%d)' % (self.mean * 1e3, self.std * 1e3,
+                                   self.bulk, self.n_samples))
+
+
+class StepEstimate(object):
+    '''
+    Predicted timing of a single protocol step.
+
+    Attributes:
+        step_number : index of the step in the protocol
+        duration : step duration in seconds
+        actuation : expected time (in seconds) for the slowest board to
+            apply the step
+        overrun_risk : probability that applying the step takes longer
+            than its duration
+        multiplex_load : fraction of the time the busiest board spends
+            writing frames while cycling through them (above 1 if it cannot
+            keep up with the refresh rate; 0 if the step is not multiplexed)
+        start, end : predicted start and end (in seconds, from the start of
+            the protocol)
+    '''
+    def __init__(self, step_number, duration, actuation, overrun_risk,
+                 multiplex_load, start, end):
+        self.step_number = step_number
+        self.duration = duration
+        self.actuation = actuation
+        self.overrun_risk = overrun_risk
+        self.multiplex_load = multiplex_load
+        self.start = start
+        self.end = end
+
+    def __repr__(self):
+        return ('StepEstimate(step_number=%d, duration=%.1f ms, '
+                'actuation=%.1f ms, overrun_risk=%.2f)' %
+                (self.step_number, self.duration * 1e3,
+                 self.actuation * 1e3, self.overrun_risk))
+
+
+class ProtocolEstimate(object):
+    '''
+    Predicted timing of a whole protocol (see estimate_protocol()).
+    '''
+    def __init__(self, steps, models):
+        self.steps = steps
+        self.models = models
+
+    @property
+    def planned_time(self):
+        '''
+        Sum of the step durations (in seconds).
+        '''
+        return sum(step.duration for step in self.steps)
+
+    @property
+    def predicted_time(self):
+        '''
+        Predicted wall time (in seconds).
+        '''
+        return self.steps[-1].end if self.steps else 0.
+
+    def warnings(self, risk_threshold=RISK_THRESHOLD):
+        '''
+        Return a list of (step_number, message) tuples for the steps whose
+        actuation is expected to exceed their duration (or is likely to),
+        and for the multiplexed steps that a board cannot refresh in time.
+        '''
+        warnings = []
+        for step in self.steps:
+            if step.actuation > step.duration:
+                warnings.append((step.step_number, 'Actuation (%.1f ms) '
+                                 'exceeds the step duration (%.1f ms).' %
+                                 (step.actuation * 1e3, step.duration * 1e3)))
+            elif step.overrun_risk > risk_threshold:
+                warnings.append((step.step_number, 'Actuation may exceed the '
+                                 'step duration (%.0f%% risk).' %
+                                 (100 * step.overrun_risk)))
+            if step.multiplex_load > 1:
+                warnings.append((step.step_number, 'The board cannot refresh '
+                                 'the multiplexed channels at the requested '
+                                 'rate (%.0f%% load).' %
+                                 (100 * step.multiplex_load)))
+        return warnings
+
+    def summary(self, risk_threshold=RISK_THRESHOLD):
+        return {'steps': len(self.steps),
+                'planned_time_s': self.planned_time,
+                'predicted_time_s': self.predicted_time,
+                'overrun_steps': sum(step.actuation > step.duration
+                                     for step in self.steps),
+                'at_risk_steps': sum(step.overrun_risk > risk_threshold
+                                     for step in self.steps)}
+
+
+def _multiplex_load(model, pin_levels, refresh_rate):
+    '''
+    Return the fraction of the time a board spends writing frames while
+    cycling through the pin levels of a step's frames.
+    '''
+    if len(pin_levels) < 2 or not refresh_rate:
+        return 0.
+    changes = (pin_levels != np.roll(pin_levels, 1, axis=0)).sum(axis=1)
+    return refresh_rate * model.cost(changes)[0].sum()
+
+
+def estimate_protocol(plan, models, refresh_rate=None):
+    '''
+    Predict the timing of each step of a compiled protocol.
+
+    Parameters:
+        plan : compiled ActuationPlan (invalid steps are skipped)
+        models : LatencyModel for each board of the plan (in the order of
+            plan.shards)
+        refresh_rate : multiplexing refresh rate (in Hz; None to ignore
+            multiplexing)
+
+    Returns:
+        ProtocolEstimate
+    '''
+    if len(models) != len(plan.shards):
+        raise ValueError('Expected %d latency models (got %d).' %
+                         (len(plan.shards), len(models)))
+    deltas = plan.pin_deltas()
+    n_pins = [deltas[:, k * N_PINS:(k + 1) * N_PINS].sum(axis=1)
+              for k in range(len(models))]
+    costs = [model.cost(pins) for model, pins in zip(models, n_pins)]
+    steps = []
+    end = deadline = 0.
+    for i, step in enumerate(plan.steps):
+        if step is None:
+            continue
+        duration = step.duration / 1000.
+        # the boards are driven concurrently, so the step is applied once
+        # the slowest one is done; it doesn't overrun only if none of them do
+        actuation = max(mean[i] for mean, variance in costs)
+        on_time = 1.
+        for mean, variance in costs:
+            if variance[i] > 0:
+                on_time *= _normal_cdf((duration - mean[i]) /
+                                       math.sqrt(variance[i]))
+            elif mean[i] > duration:
+                on_time = 0.
+        load = max(_multiplex_load(model, pin_levels, refresh_rate)
+                   for model, pin_levels in zip(models,
+                                                step.shard_pin_levels))
+        start = end
+        deadline += duration
+        # steps end at absolute deadlines, so time lost to a slow step is
+        # recovered from the slack of the following steps
+        end = max(start + actuation, deadline)
+        steps.append(StepEstimate(i, duration, actuation, 1 - on_time, load,
+                                  start, end))
+    return ProtocolEstimate(steps, models)
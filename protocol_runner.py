@@ -0,0 +1,260 @@
+"""
+Run a MicroDrop protocol on an OpenDrop board without MicroDrop or a display.
+
+    python protocol_runner.py protocol_file [--port PORT | --simulate]
+        [--repeat N] [--refresh-rate HZ] [--estimate] [--json]
+
+The channel states of each step are read from the protocol's device
+controller data, and the duration, voltage and frequency from the OpenDrop
+plugin's step options. Steps are scheduled against absolute deadlines (see
+StepTimer) and timing and throughput statistics are printed at the end.
+With --estimate, the predicted run time (see protocol_estimate.py) is
+printed instead of running the protocol.
+"""
+import sys
+import json
+import time
+import logging
+import argparse
+
+import numpy as np
+
+from opendrop_board import OpenDropBoard
+from board_worker import BoardWorker
+from channel_state import ChannelState
+from step_timer import StepTimer, monotonic
+from actuation_plan import ActuationPlan
+from diagnostics import LatencyStats
+from protocol_estimate import LatencyModel, estimate_protocol
+
+
+PLUGIN_NAME = 'opendrop'
+DEVICE_CONTROLLER_NAME = 'microdrop.gui.dmf_device_controller'
+# defaults of the plugin's step options (see OpenDropPlugin.StepFields)
+DEFAULT_STEP_OPTIONS = {'duration': 100, 'voltage': 100, 'frequency': 10e3}
+# maximum time (in seconds) to wait for the channels to be cleared at the
+# end of a run
+CLEAR_TIMEOUT = 5.0
+
+
+def load_protocol_steps(protocol_path, plugin_name=PLUGIN_NAME):
+    '''
+    Load a MicroDrop protocol file.
+
+    Returns:
+        list of (options, state_of_channels) tuples, one per step (see
+        ActuationPlan.compile())
+    '''
+    from microdrop.protocol import Protocol
+
+    protocol = Protocol.load(protocol_path)
+    steps = []
+    for step in protocol.steps:
+        options = dict(DEFAULT_STEP_OPTIONS)
+        options.update(step.get_data(plugin_name) or {})
+        device_options = step.get_data(DEVICE_CONTROLLER_NAME)
+        if device_options is None:
+            state = np.zeros(0, dtype=int)
+        else:
+            state = device_options.state_of_channels
+        steps.append((options, state))
+    return steps
+
+
+class ProtocolRunner(object):
+    '''
+    Apply a compiled protocol to a board, step by step.
+
+    The board is driven through a BoardWorker (which cycles through the
+    frames of multiplexed steps), and each step ends at a deadline measured
+    from the start of the run, so time spent actuating a step is subtracted
+    from its duration instead of accumulating.
+    '''
+    def __init__(self, board, plan, refresh_rate=25):
+        self.board = board
+        self.plan = plan
+        self.refresh_rate = refresh_rate
+        self.step_timer = StepTimer()
+        self.actuation_stats = LatencyStats(maxlen=100000)
+        self.overruns = 0
+        self.errors = 0
+        self.worker = BoardWorker(board)
+
+    def run(self, repeat=1):
+        '''
+        Run the protocol `repeat` times.
+
+        Returns:
+            total wall time in seconds
+        '''
+        self.worker.start()
+        waveform = None
+        start = monotonic()
+        try:
+            for i in range(repeat):
+                for step_number, step in enumerate(self.plan.steps):
+                    if (step.voltage, step.frequency) != waveform:
+                        waveform = step.voltage, step.frequency
+                        self.worker.submit('set_waveform_voltage',
+                                           step.voltage)
+                        self.worker.submit('set_waveform_frequency',
+                                           step.frequency)
+                    self._run_step(step_number, step)
+        finally:
+            # never leave electrodes energized (e.g., after an error or
+            # Ctrl-C); this also stops any multiplexing
+            self._clear_channels()
+            self.worker.stop()
+        return monotonic() - start
+
+    def _clear_channels(self):
+        result = self.worker.set_state([ChannelState()])
+        if not result.wait(CLEAR_TIMEOUT):
+            logging.error('[ProtocolRunner] channels were not cleared within '
+                          '%.1f s' % CLEAR_TIMEOUT)
+        elif result.error is not None:
+            logging.error('[ProtocolRunner] could not clear the channels: %s'
+                          % result.error)
+
+    def _run_step(self, step_number, step):
+        step_start = monotonic()
+        self.step_timer.start_step(step_number, step.duration)
+        result = self.worker.set_state(step.frames, self.refresh_rate,
+                                       step_number=step_number,
+                                       pin_levels=step.pin_levels)
+        result.wait()
+        if result.error is not None:
+            self.errors += 1
+        else:
+            self.step_timer.state_applied()
+            latency = monotonic() - step_start
+            self.actuation_stats.record('step_actuation', latency)
+            if latency * 1000 > step.duration:
+                self.overruns += 1
+        remaining = self.step_timer.remaining()
+        if remaining > 0:
+            time.sleep(remaining / 1000.)
+
+    def statistics(self, wall_time):
+        '''
+        Return a dictionary of timing and throughput statistics for a run
+        that took `wall_time` seconds.
+        '''
+        records = self.step_timer.records
+        drift = np.array([record.actual_start - record.planned_start
+                          for record in records]) * 1e3
+        planned_time = sum(record.duration for record in records)
+        return {'steps': len(records),
+                'wall_time_s': wall_time,
+                'planned_time_s': planned_time,
+                'steps_per_second': len(records) / wall_time,
+                'final_drift_ms': drift[-1] if len(drift) else 0.,
+                'max_drift_ms': drift.max() if len(drift) else 0.,
+                'overruns': self.overruns,
+                'errors': self.errors,
+                'superseded_states': self.worker.superseded_count,
+                'step_actuation': self.actuation_stats.summary()
+                .get('step_actuation'),
+                'rpc': self.board.rpc_stats.summary(),
+                'bytes_written': self.board.bytes_written,
+                'bytes_read': self.board.bytes_read}
+
+
+def print_statistics(stats, output=sys.stdout):
+    output.write('%(steps)d steps in %(wall_time_s).3f s (planned: '
+                 '%(planned_time_s).3f s, %(steps_per_second).1f steps/s)\n'
+                 % stats)
+    output.write('drift: final %(final_drift_ms).1f ms, max %(max_drift_ms).1f'
+                 ' ms; %(overruns)d overruns, %(errors)d errors\n' % stats)
+    if stats['step_actuation']:
+        output.write('step actuation: mean %(mean).2f ms, p50 %(p50).2f ms, '
+                     'p95 %(p95).2f ms, p99 %(p99).2f ms\n' %
+                     stats['step_actuation'])
+    for name, rpc in sorted(stats['rpc'].items()):
+        output.write('  %-24s %6d calls, mean %.2f ms, p95 %.2f ms\n' %
+                     (name, rpc['count'], rpc['mean'], rpc['p95']))
+    output.write('%(bytes_written)d bytes written, %(bytes_read)d bytes read\n'
+                 % stats)
+
+
+def print_estimate(estimate, output=sys.stdout):
+    output.write('%(steps)d steps: predicted %(predicted_time_s).3f s '
+                 '(planned: %(planned_time_s).3f s); %(overrun_steps)d steps '
+                 'overrun, %(at_risk_steps)d at risk\n' % estimate.summary())
+    for model in estimate.models:
+        output.write('  %r\n' % model)
+    for step_number, warning in estimate.warnings():
+        output.write('  step %d: %s\n' % (step_number + 1, warning))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('protocol', help='MicroDrop protocol file')
+    parser.add_argument('--port', help='serial port of the board (default: '
+                        'search all ports)')
+    parser.add_argument('--simulate', action='store_true',
+                        help='run against a simulated board (see '
+                        'simulator.py; equivalent to --port sim://)')
+    parser.add_argument('--baud-rate', type=int, default=115200)
+    parser.add_argument('--refresh-rate', type=float, default=25,
+                        help='multiplexing refresh rate (Hz)')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='number of times to run the protocol')
+    parser.add_argument('--plugin-name', default=PLUGIN_NAME,
+                        help='name the step options are stored under')
+    parser.add_argument('--estimate', action='store_true',
+                        help='only print the predicted run time')
+    parser.add_argument('--json', action='store_true',
+                        help='print the statistics as JSON')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    steps = load_protocol_steps(args.protocol, args.plugin_name)
+
+    board = OpenDropBoard()
+    try:
+        board.connect('sim://' if args.simulate else args.port,
+                      args.baud_rate)
+    except (RuntimeError, IOError), why:
+        logging.error('[ProtocolRunner] could not connect to the board: %s'
+                      % why)
+        return 1
+    if not board.connected():
+        logging.error('[ProtocolRunner] no OpenDrop board found.')
+        return 1
+
+    plan = ActuationPlan(board.number_of_channels(),
+                         board.max_waveform_voltage,
+                         board.min_waveform_frequency,
+                         board.max_waveform_frequency)
+    plan.compile(steps)
+    errors = plan.errors()
+    for step_number, error in errors:
+        logging.warning('[ProtocolRunner] step %d: %s' % (step_number + 1,
+                                                          error))
+
+    if args.estimate:
+        estimate = estimate_protocol(plan, [LatencyModel.fit(board)],
+                                     args.refresh_rate)
+        board.disconnect()
+        if args.json:
+            print json.dumps(estimate.summary(), indent=2, sort_keys=True)
+        else:
+            print_estimate(estimate)
+        return 0
+
+    runner = ProtocolRunner(board, plan, args.refresh_rate)
+    try:
+        wall_time = runner.run(args.repeat)
+    finally:
+        board.disconnect()
+    stats = runner.statistics(wall_time)
+    if args.json:
+        print json.dumps(stats, indent=2, sort_keys=True)
+    else:
+        print_statistics(stats)
+    return 1 if runner.errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
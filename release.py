@@ -17,7 +17,12 @@ with open('properties.yml', 'w') as f:
 
 # create the tar.gz plugin archive
 with tarfile.open("%s-%s.tar.gz" % (package_name, version), "w:gz") as tar:
-    for name in ['__init__.py', 'opendrop_board.py', 'properties.yml', 'hooks', 
-                 'on_plugin_install.py', 'requirements.txt',
-                 'COPYING']:
+    for name in ['__init__.py', 'opendrop_board.py', 'channel_map.py',
+                 'channel_state.py', 'board_worker.py', 'board_group.py',
+                 'connection_watchdog.py', 'firmware_cache.py',
+                 'step_timer.py', 'actuation_plan.py', 'actuation_log.py',
+                 'port_discovery.py', 'diagnostics.py', 'simulator.py',
+                 'protocol_runner.py', 'protocol_estimate.py',
+                 'properties.yml', 'hooks', 'on_plugin_install.py',
+                 'requirements.txt', 'COPYING']:
         tar.add(name)
@@ -0,0 +1,167 @@
+"""
+In-process simulation of an OpenDrop board and its serial link.
+
+A simulated board is selected by connecting to a port of the form
+
+    sim://[?option=value&...]
+
+where the options are:
+
+    transaction_latency : latency (in seconds) added to every request
+        (default: 0.004, typical of a USB-serial adapter)
+    byte_latency : time (in seconds) to transfer one byte (default: 10 bits
+        at the connection's baud rate)
+    bulk : if 1, the firmware provides the bulk digital_write_multiple and
+        pin_mode_multiple commands (default: 0)
+    name : name reported by the board (default: open_drop)
+"""
+import time
+import urlparse
+
+import numpy as np
+
+from channel_map import (LOW, HIGH, N_GATES, N_SOURCES, FIRST_PIN, N_PINS,
+                         CHANNEL_GATE, CHANNEL_SOURCE)
+
+
+SIMULATED_PORT_PREFIX = 'sim://'
+
+DEFAULT_TRANSACTION_LATENCY = 0.004
+
+# approximate packet sizes (in bytes) of requests and responses
+REQUEST_HEADER_SIZE = 8
+RESPONSE_SIZE = 8
+PROPERTIES_RESPONSE_SIZE = 128
+
+
+def is_simulated_port(serial_port):
+    return str(serial_port).startswith(SIMULATED_PORT_PREFIX)
+
+
+def open_simulated_port(serial_port, baud_rate=115200):
+    '''
+    Create the simulated serial device and proxy for a `sim://` port.
+
+    Returns:
+        (serial_device, proxy) tuple
+    '''
+    query = urlparse.parse_qs(serial_port[len(SIMULATED_PORT_PREFIX):]
+                              .lstrip('?'))
+    options = dict((k, v[-1]) for k, v in query.items())
+    serial_device = SimulatedSerial(
+        serial_port, baudrate=baud_rate,
+        byte_latency=float(options.get('byte_latency', 10. / baud_rate)))
+    if int(options.get('bulk', 0)):
+        proxy_class = SimulatedBulkProxy
+    else:
+        proxy_class = SimulatedProxy
+    proxy = proxy_class(serial_device,
+                        transaction_latency=float(
+                            options.get('transaction_latency',
+                                        DEFAULT_TRANSACTION_LATENCY)),
+                        name=options.get('name', 'open_drop'))
+    return serial_device, proxy
+
+
+class SimulatedSerial(object):
+    '''
+    Stand-in for a pyserial Serial object that delays each transfer by a
+    fixed time per byte.
+    '''
+    def __init__(self, port, baudrate=115200, byte_latency=0., **kwargs):
+        self.port = port
+        self.baudrate = baudrate
+        self.byte_latency = byte_latency
+        self._open = True
+
+    def isOpen(self):
+        return self._open
+
+    def close(self):
+        self._open = False
+
+    def write(self, data):
+        if not self._open:
+            raise IOError('Port %s is closed.' % self.port)
+        time.sleep(len(data) * self.byte_latency)
+        return len(data)
+
+    def read(self, size=1):
+        if not self._open:
+            raise IOError('Port %s is closed.' % self.port)
+        time.sleep(size * self.byte_latency)
+        return '\0' * size
+
+
+class SimulatedProxy(object):
+    '''
+    Simulated open-drop proxy implementing the base_node_rpc commands used by
+    OpenDropBoard, and modelling the pin levels, pin modes and the resulting
+    state of the gate/source electrode matrix.
+    '''
+    def __init__(self, serial_device, transaction_latency=0.,
+                 name='open_drop'):
+        self.serial_device = serial_device
+        self.transaction_latency = transaction_latency
+        self.name = name
+        self.pin_levels = np.zeros(N_PINS, dtype=np.uint8)
+        self.pin_modes = np.zeros(N_PINS, dtype=np.uint8)
+        self.transaction_count = 0
+
+    def _transaction(self, request_size, response_size=RESPONSE_SIZE):
+        self.serial_device.write('\0' * (REQUEST_HEADER_SIZE + request_size))
+        time.sleep(self.transaction_latency)
+        self.serial_device.read(response_size)
+        self.transaction_count += 1
+
+    def _pin_index(self, pin):
+        if not FIRST_PIN <= pin < FIRST_PIN + N_PINS:
+            raise ValueError('Pin %d is not connected to the electrode '
+                             'matrix.' % pin)
+        return pin - FIRST_PIN
+
+    def properties(self):
+        self._transaction(0, PROPERTIES_RESPONSE_SIZE)
+        try:
+            import pkg_resources
+
+            software_version = (pkg_resources.get_distribution('open_drop')
+                                .version)
+        except Exception:
+            software_version = 'simulated'
+        return {'name': self.name, 'software_version': software_version}
+
+    def pin_mode(self, pin, mode):
+        self._transaction(2)
+        self.pin_modes[self._pin_index(pin)] = mode
+
+    def digital_write(self, pin, level):
+        self._transaction(2)
+        self.pin_levels[self._pin_index(pin)] = level
+
+    def actuated_channels(self):
+        '''
+        Return a boolean array with the channels that are currently actuated
+        (i.e., whose gate is driven high and whose source is driven low).
+        '''
+        driven = self.pin_modes == 1
+        gates = np.zeros(N_GATES, dtype=bool)
+        gates[:] = driven[:N_GATES] & (self.pin_levels[:N_GATES] == HIGH)
+        sources = np.zeros(N_SOURCES + 1, dtype=bool)
+        sources[1:] = driven[N_GATES:] & (self.pin_levels[N_GATES:] == LOW)
+        return gates[CHANNEL_GATE] & sources[CHANNEL_SOURCE]
+
+
+class SimulatedBulkProxy(SimulatedProxy):
+    '''
+    Simulated proxy for a firmware that also provides bulk pin commands.
+    '''
+    def digital_write_multiple(self, pins, levels):
+        self._transaction(2 * len(pins))
+        for pin, level in zip(pins, levels):
+            self.pin_levels[self._pin_index(pin)] = level
+
+    def pin_mode_multiple(self, pins, modes):
+        self._transaction(2 * len(pins))
+        for pin, mode in zip(pins, modes):
+            self.pin_modes[self._pin_index(pin)] = mode
@@ -0,0 +1,103 @@
+"""
+Drift-free scheduling of protocol steps.
+"""
+import time
+
+try:
+    from monotonic import monotonic
+except ImportError:
+    monotonic = time.time
+
+
+class StepRecord(object):
+    '''
+    Timing of a single protocol step. All times are in seconds relative to
+    the start of the protocol run.
+    '''
+    def __init__(self, step_number, duration, planned_start, actual_start):
+        self.step_number = step_number
+        self.duration = duration
+        self.planned_start = planned_start
+        self.actual_start = actual_start
+        self.applied = None
+
+    @property
+    def actuation_time(self):
+        '''
+        Time between the start of the step and the board applying its
+        state (None if the state has not been applied).
+        '''
+        if self.applied is None:
+            return None
+        return self.applied - self.actual_start
+
+    def __repr__(self):
+        return ('StepRecord(step_number=%d, duration=%.3f, '
+                'planned_start=%.3f, actual_start=%.3f)' %
+                (self.step_number, self.duration, self.planned_start,
+                 self.actual_start))
+
+
+class StepTimer(object):
+    '''
+    Schedule protocol steps against absolute deadlines measured from the start
+    of the protocol run, so that time spent actuating a step (or any other
+    delay) is subtracted from its duration rather than accumulating over the
+    protocol.
+    '''
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        '''
+        Restart the schedule (e.g., when a protocol starts or is resumed).
+        '''
+        self.origin = None
+        self.next_start = None
+        self.records = []
+
+    def start_step(self, step_number, duration):
+        '''
+        Record the start of a step.
+
+        Parameters:
+            step_number : index of the step in the protocol
+            duration : step duration in ms
+
+        Returns:
+            StepRecord for the step
+        '''
+        now = monotonic()
+        if self.origin is None:
+            self.origin = now
+            self.next_start = now
+        record = StepRecord(step_number, duration / 1000.,
+                            self.next_start - self.origin, now - self.origin)
+        self.next_start += duration / 1000.
+        self.records.append(record)
+        return record
+
+    def state_applied(self):
+        '''
+        Record that the board has applied the state of the current step.
+        '''
+        if self.records:
+            self.records[-1].applied = monotonic() - self.origin
+
+    def remaining(self):
+        '''
+        Return the time (in ms) remaining until the current step's deadline
+        (zero if the deadline has already passed).
+        '''
+        if self.next_start is None:
+            return 0
+        return max(0, int(round((self.next_start - monotonic()) * 1000)))
+
+    def drift(self):
+        '''
+        Return the difference (in seconds) between the actual and planned
+        start of the most recent step.
+        '''
+        if not self.records:
+            return 0.
+        return self.records[-1].actual_start - self.records[-1].planned_start
@@ -0,0 +1,84 @@
+"""
+Shared fixtures. The tests run against simulated boards (see simulator.py),
+so they need neither hardware nor MicroDrop.
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from opendrop_board import OpenDropBoard
+from channel_map import N_CHANNELS
+from channel_state import ChannelState
+
+
+# simulated boards without link latency, with and without the bulk digital
+# write command
+SIM_PORTS = ['sim://?transaction_latency=0&byte_latency=0',
+             'sim://?transaction_latency=0&byte_latency=0&bulk=1']
+
+
+@pytest.fixture(params=SIM_PORTS, ids=['per_pin', 'bulk'])
+def board(request):
+    board = OpenDropBoard()
+    board.connect(request.param)
+    yield board
+    board.disconnect()
+
+
+@pytest.fixture
+def random_states():
+    '''
+    Random channel states with 1 to 10 active channels.
+    '''
+    random = np.random.RandomState(0)
+    return [ChannelState.from_channels(random.choice(N_CHANNELS,
+                                                     random.randint(1, 11),
+                                                     replace=False))
+            for i in range(200)]
+
+
+class ActuationMonitor(object):
+    '''
+    Records the channels actuated by a simulated board after every pin
+    write.
+    '''
+    def __init__(self, board):
+        self.proxy = board.proxy
+        self.snapshots = []
+        self._digital_write = self.proxy.digital_write
+        self.proxy.digital_write = self._record_digital_write
+        if hasattr(self.proxy, 'digital_write_multiple'):
+            self._digital_write_multiple = self.proxy.digital_write_multiple
+            self.proxy.digital_write_multiple = \
+                self._record_digital_write_multiple
+
+    def _record_digital_write(self, pin, level):
+        self._digital_write(pin, level)
+        self.snapshots.append(self.actuated())
+
+    def _record_digital_write_multiple(self, pins, levels):
+        self._digital_write_multiple(pins, levels)
+        self.snapshots.append(self.actuated())
+
+    def actuated(self):
+        return ChannelState.from_array(self.proxy.actuated_channels())
+
+    def all_actuated(self):
+        '''
+        Return every channel actuated since the last call.
+        '''
+        channels = ChannelState()
+        for snapshot in self.snapshots:
+            channels |= snapshot
+        self.snapshots = []
+        return channels
+
+
+@pytest.fixture
+def monitor(board):
+    return ActuationMonitor(board)
@@ -0,0 +1,54 @@
+import numpy as np
+
+from actuation_plan import ActuationPlan, validate_waveforms
+from channel_map import N_PINS, state_to_pin_levels
+from channel_state import ChannelState
+
+
+def test_validate_waveforms():
+    errors = validate_waveforms([100, 200, 50, 150], [1e3, 10e3, 50, 20e3],
+                                max_voltage=120, min_frequency=100,
+                                max_frequency=15e3)
+    assert [step_number for step_number, message in errors] == [1, 2, 3, 3]
+    assert 'Voltage' in errors[0][1]
+    assert 'Frequency' in errors[1][1]
+
+
+def test_validate_waveforms_without_limits():
+    assert validate_waveforms([1e6], [1e9]) == []
+
+
+def _state(channels, n_channels=68):
+    return ChannelState.from_channels(channels).to_array(n_channels)
+
+
+def test_compiled_pin_levels_match_frames():
+    options = {'duration': 100, 'voltage': 100, 'frequency': 10e3}
+    plan = ActuationPlan(68)
+    plan.compile([(options, _state([4])), (options, _state([4, 13]))])
+    assert len(plan.get(0).frames) == 1
+    assert len(plan.get(1).frames) == 2
+    for step in plan.steps:
+        assert step.pin_levels.shape == (len(step.frames), N_PINS)
+        for frame, levels in zip(step.frames, step.pin_levels):
+            assert (levels == state_to_pin_levels(frame)[0]).all()
+
+
+def test_shards_are_compiled_separately():
+    options = {'duration': 100, 'voltage': 100, 'frequency': 10e3}
+    plan = ActuationPlan(136, shards=[(0, 68), (68, 68)])
+    plan.compile([(options, _state([4, 72], 136))])
+    step = plan.get(0)
+    assert step.shard_frames == [[ChannelState.from_channels([4])],
+                                 [ChannelState.from_channels([4])]]
+    assert np.allclose(step.duty_cycle[[4, 72]], 1)
+
+
+def test_errors_report_invalid_steps():
+    plan = ActuationPlan(68, max_voltage=120)
+    plan.compile([({'duration': 100, 'voltage': 150, 'frequency': 10e3},
+                   _state([70], 71))])
+    messages = [message for step_number, message in plan.errors()]
+    assert len(messages) == 2
+    assert 'exceed the number of channels' in messages[0]
+    assert 'Voltage' in messages[1]
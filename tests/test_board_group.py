@@ -0,0 +1,40 @@
+import pytest
+
+from board_group import Barrier, parse_board_map
+
+
+def test_parse_board_map():
+    assert parse_board_map('68-135:COM4, 0-67:COM3') == [(0, 68, 'COM3'),
+                                                         (68, 68, 'COM4')]
+    assert parse_board_map(' 0 - 9 : sim://?name=a ') == [(0, 10,
+                                                           'sim://?name=a')]
+
+
+@pytest.mark.parametrize('board_map', ['', None, ' , '])
+def test_empty_board_map(board_map):
+    assert parse_board_map(board_map) == []
+
+
+@pytest.mark.parametrize('board_map, message', [
+    ('0-67', 'Invalid board map entry'),
+    ('0-67:COM3; 68-135:COM4', 'Invalid board map entry'),
+    ('0-68:COM3', 'Invalid channel range'),
+    ('10-5:COM3', 'Invalid channel range'),
+    ('0-67:COM3, 60-100:COM4', 'overlap'),
+    ('0-9:COM3, 10-19:COM3', 'only appear once'),
+])
+def test_board_map_errors(board_map, message):
+    with pytest.raises(ValueError) as excinfo:
+        parse_board_map(board_map)
+    assert message in str(excinfo.value)
+
+
+def test_barrier_reports_first_error():
+    calls = []
+    barrier = Barrier(3, lambda value, error: calls.append(error))
+    error = IOError('board 2')
+    barrier(None, None)
+    barrier(None, error)
+    assert calls == []
+    barrier(None, IOError('board 3'))
+    assert calls == [error]
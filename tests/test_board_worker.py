@@ -0,0 +1,86 @@
+import threading
+import time
+
+import pytest
+
+from board_worker import BoardWorker
+from channel_map import multiplex_frames, state_to_pin_levels
+from channel_state import ChannelState
+
+
+@pytest.fixture
+def worker(board):
+    worker = BoardWorker(board)
+    worker.start()
+    yield worker
+    worker.stop()
+
+
+def test_call_returns_value_and_raises(worker):
+    assert worker.call('number_of_channels') == 68
+    with pytest.raises(ValueError):
+        worker.call('apply_pin_levels', [0])
+
+
+def test_superseded_states_are_dropped(board, worker):
+    release = threading.Event()
+    board.wait_for_release = release.wait
+    worker.submit('wait_for_release')
+    states = [ChannelState.from_channels([channel])
+              for channel in (4, 5, 6)]
+    results = [worker.set_state([state]) for state in states]
+    release.set()
+    assert results[-1].wait(5)
+    assert [result.superseded for result in results] == [True, True, False]
+    assert worker.superseded_count == 2
+    assert (board.proxy.pin_levels ==
+            state_to_pin_levels(states[-1])[0]).all()
+
+
+def test_callbacks_report_errors(board, worker):
+    results = []
+    done = threading.Event()
+
+    def callback(value, error):
+        results.append(error)
+        done.set()
+
+    worker.submit('apply_pin_levels', [0], callback=callback)
+    assert done.wait(5)
+    assert isinstance(results[0], ValueError)
+
+
+def test_precompiled_pin_levels(board, worker):
+    state = ChannelState.from_channels([4, 13])
+    frames = multiplex_frames(state)[0]
+    levels = [state_to_pin_levels(frame)[0] for frame in frames]
+    assert worker.set_state(frames, 1, pin_levels=levels).wait(5)
+    assert (board.proxy.pin_levels == levels[0]).all()
+
+
+def test_multiplexing_only_actuates_requested_channels(board, monitor,
+                                                       worker):
+    state = ChannelState.from_channels([4, 13])
+    frames = multiplex_frames(state)[0]
+    assert len(frames) == 2
+    assert worker.set_state(frames, 25).wait(5)
+    time.sleep(0.3)
+    assert worker.set_state([ChannelState()]).wait(5)
+    # both frames were applied, and nothing else was ever actuated
+    assert monitor.all_actuated() == state
+
+
+def test_refresh_rate_is_lowered_when_frames_are_slow(worker):
+    board = worker.board
+    apply_pin_levels = board.apply_pin_levels
+
+    def slow_apply_pin_levels(levels, force=False):
+        time.sleep(0.02)
+        return apply_pin_levels(levels, force)
+
+    board.apply_pin_levels = slow_apply_pin_levels
+    frames = multiplex_frames(ChannelState.from_channels([4, 13]))[0]
+    assert worker.set_state(frames, 100).wait(5)
+    time.sleep(0.2)
+    # two frames take at least 40 ms to cycle through
+    assert worker.effective_refresh_rate < 25
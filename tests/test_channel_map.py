@@ -0,0 +1,50 @@
+import numpy as np
+
+from channel_map import (N_CHANNELS, CLEARED_PIN_LEVELS, state_to_pin_levels,
+                         multiplex_frames)
+from channel_state import ChannelState
+
+
+def test_cleared_state():
+    levels, unrepresentable = state_to_pin_levels(ChannelState())
+    assert (levels == CLEARED_PIN_LEVELS).all()
+    assert not unrepresentable
+
+
+def test_unrepresentable_channels():
+    # channels 4 (G1/S1) and 13 (G2/S2) also actuate 5 (G1/S2) and 12
+    # (G2/S1)
+    levels, unrepresentable = state_to_pin_levels(
+        ChannelState.from_channels([4, 13]))
+    assert set(unrepresentable) == set([5, 12])
+
+
+def test_representable_state_is_a_single_frame():
+    state = ChannelState.from_channels([4, 5, 6])
+    frames, duty_cycle = multiplex_frames(state)
+    assert frames == [state]
+    assert (duty_cycle == state.to_array(N_CHANNELS)).all()
+
+
+def test_frames_split_state_exactly(random_states):
+    for state in random_states:
+        frames, duty_cycle = multiplex_frames(state)
+        union = ChannelState()
+        for frame in frames:
+            # each frame can be driven on its own, and no channel is in more
+            # than one frame
+            assert not state_to_pin_levels(frame)[1]
+            assert not union & frame
+            union |= frame
+        assert union == state
+        expected = state.to_array(N_CHANNELS) / float(len(frames))
+        assert np.allclose(duty_cycle, expected)
+
+
+def test_frames_group_gates_driving_the_same_sources():
+    # channels 4-11 share G1, channels 4, 12, 20, ... share S1
+    state = ChannelState.from_channels(range(4, 12) + [20, 28])
+    frames = multiplex_frames(state)[0]
+    expected = [ChannelState.from_channels([20, 28]),
+                ChannelState.from_channels(range(4, 12))]
+    assert sorted(frames, key=ChannelState.count) == expected
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+from channel_state import ChannelState
+
+
+def test_array_round_trip():
+    array = np.zeros(136, dtype=bool)
+    array[[0, 5, 67, 135]] = True
+    state = ChannelState.from_array(array)
+    assert list(state) == [0, 5, 67, 135]
+    assert (state.to_array(136) == array).all()
+
+
+def test_to_array_checks_range():
+    with pytest.raises(ValueError):
+        ChannelState.from_channels([68]).to_array(68)
+
+
+def test_negative_bits():
+    with pytest.raises(ValueError):
+        ChannelState(-1)
+
+
+def test_set_operators():
+    a = ChannelState.from_channels([1, 2, 3])
+    b = ChannelState.from_channels([3, 4])
+    assert list(a | b) == [1, 2, 3, 4]
+    assert list(a & b) == [3]
+    assert list(a ^ b) == [1, 2, 4]
+    assert list(a - b) == [1, 2]
+
+
+def test_queries():
+    state = ChannelState.from_channels([2, 9, 70])
+    assert state.count() == 3
+    assert state.max_channel() == 70
+    assert 9 in state and 3 not in state
+    assert state and not ChannelState()
+    assert state == ChannelState.from_channels([70, 9, 2])
+    assert hash(state) == hash(ChannelState.from_channels([2, 9, 70]))
+    assert list(state.slice(5, 66)) == [4, 65]
@@ -0,0 +1,90 @@
+import numpy as np
+import pytest
+
+from channel_map import (LOW, HIGH, FIRST_PIN, N_PINS, CLEARED_PIN_LEVELS,
+                         multiplex_frames, state_to_pin_levels)
+from channel_state import ChannelState
+
+
+def baseline_pin_levels(channels):
+    '''
+    Return the pin levels left by the original implementation of
+    set_state_of_all_channels(), which cleared every channel and then set
+    the gate and source of each active channel.
+    '''
+    levels = dict([(2 + gate, LOW) for gate in range(9)] +
+                  [(10 + source, HIGH) for source in range(1, 9)])
+    for channel in channels:
+        if channel < 2:
+            gate, source = 0, 2 * channel + 1
+        elif channel < 4:
+            gate, source = 0, 2 * channel + 2
+        else:
+            gate, source = (channel - 4) / 8 + 1, (channel - 4) % 8 + 1
+        levels[2 + gate] = HIGH
+        levels[10 + source] = LOW
+    return np.array([levels[pin] for pin in range(FIRST_PIN,
+                                                  FIRST_PIN + N_PINS)])
+
+
+def test_connect_clears_all_channels(board):
+    assert (board.proxy.pin_levels == CLEARED_PIN_LEVELS).all()
+    assert not board.proxy.actuated_channels().any()
+
+
+def test_pin_levels_match_baseline(board, random_states):
+    for state in random_states:
+        board.set_state_of_all_channels(state)
+        assert (board.proxy.pin_levels ==
+                baseline_pin_levels(list(state))).all()
+
+
+def test_only_changed_pins_are_written(board):
+    board.set_state_of_all_channels(ChannelState.from_channels([4]))
+    count = board.proxy.transaction_count
+    board.set_state_of_all_channels(ChannelState.from_channels([4]))
+    assert board.proxy.transaction_count == count
+
+
+def test_clear_all_channels(board, random_states):
+    board.set_state_of_all_channels(random_states[0])
+    board.clear_all_channels()
+    assert (board.proxy.pin_levels == CLEARED_PIN_LEVELS).all()
+
+
+@pytest.mark.parametrize('channels', [(4, 13), (13, 4), (0, 67), (67, 0)])
+def test_transition_does_not_actuate_other_channels(board, monitor,
+                                                    channels):
+    first, second = [ChannelState.from_channels([channel])
+                     for channel in channels]
+    board.set_state_of_all_channels(first)
+    monitor.all_actuated()
+    board.set_state_of_all_channels(second)
+    assert monitor.all_actuated() == second
+
+
+def test_transitions_only_actuate_requested_channels(board, monitor,
+                                                     random_states):
+    # frames are states that the gate/source matrix can represent
+    frames = [frame for state in random_states
+              for frame in multiplex_frames(state)[0]]
+    previous = ChannelState()
+    for frame in frames:
+        board.set_state_of_all_channels(frame)
+        assert monitor.all_actuated() - (previous | frame) == ChannelState()
+        assert monitor.actuated() == frame
+        previous = frame
+
+
+def test_force_full_refresh_keeps_state(board, monitor):
+    state = ChannelState.from_channels([5, 6, 13, 14])
+    board.set_state_of_all_channels(state)
+    monitor.all_actuated()
+    board.force_full_refresh()
+    assert monitor.all_actuated() == state
+    assert (board.proxy.pin_levels == state_to_pin_levels(state)[0]).all()
+
+
+def test_apply_pin_levels_checks_length(board):
+    with pytest.raises(ValueError):
+        board.apply_pin_levels(CLEARED_PIN_LEVELS[:-1])
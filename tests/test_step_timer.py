@@ -0,0 +1,62 @@
+import pytest
+
+import step_timer
+from step_timer import StepTimer
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 100.
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(step_timer, 'monotonic', clock)
+    return clock
+
+
+def test_steps_end_at_absolute_deadlines(clock):
+    timer = StepTimer()
+    timer.start_step(0, 100)
+    clock.now += 0.03
+    timer.state_applied()
+    assert timer.remaining() == 70
+    # the next step starts 20 ms late; its deadline doesn't move
+    clock.now += 0.09
+    record = timer.start_step(1, 100)
+    assert record.planned_start == pytest.approx(0.1)
+    assert timer.drift() == pytest.approx(0.02)
+    assert timer.remaining() == 80
+    assert timer.records[0].actuation_time == pytest.approx(0.03)
+
+
+def test_remaining_is_never_negative(clock):
+    timer = StepTimer()
+    assert timer.remaining() == 0
+    timer.start_step(0, 10)
+    clock.now += 1
+    assert timer.remaining() == 0
+
+
+def test_drift_does_not_accumulate(clock):
+    timer = StepTimer()
+    for i in range(100):
+        timer.start_step(i, 20)
+        # every step takes 1 ms longer to start than planned...
+        clock.now += 0.001
+        # ...and waits only for the time left until its deadline
+        clock.now += timer.remaining() / 1000.
+    assert timer.drift() < 0.002
+
+
+def test_reset(clock):
+    timer = StepTimer()
+    timer.start_step(0, 10)
+    timer.reset()
+    assert timer.records == [] and timer.drift() == 0.
+    clock.now += 5
+    assert timer.start_step(0, 10).planned_start == 0.